@@ -0,0 +1,61 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Throughput + correctness check of the fetchEnsemblSequences.py fetch
+engine against the local mock Ensembl server with injected latency,
+5xx errors and 429 rate limiting. Every requested ID must come back
+with the sequence the mock server generates for it.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, (Path(__file__).resolve().parents[1] / 'scripts').as_posix())
+from fetchEnsemblSequences import fetchSequences
+from mockEnsemblServer import fakeSequence, startMockServer
+
+
+def makeIDs(count, missing):
+    ids = [f"ENSMOCKP{n:011d}" if n % 2 else f"ENSMOCKG{n:011d}" for n in range(count)]
+    ids += [f"ENSMOCKPMISSING{n:05d}" for n in range(missing)]
+    return ids
+
+
+def runFetch(url, ids, threads, rate, batchSize):
+    start = time.perf_counter()
+    results, failures = fetchSequences(ids, url, batchSize=batchSize, workers=threads, rate=rate, backoff=0.05)
+    elapsed = time.perf_counter() - start
+    wrong = [i for i, r in results.items() if r['seq'] != fakeSequence(i)]
+    missing = [i for i in ids if (i not in results) and ('MISSING' not in i)]
+    return elapsed, len(results), len(failures), len(wrong), len(missing)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Ensembl fetch engine against a mock server')
+    parser.add_argument('--ids', type=int, action='store', default=1000, help='Number of IDs to fetch')
+    parser.add_argument('--missing', type=int, action='store', default=10, help='Number of unknown IDs mixed in')
+    parser.add_argument('--threads', type=str, action='store', default='1,4,8', help='Comma separated thread counts to compare')
+    parser.add_argument('--rate', type=float, action='store', default=15, help='Requests per second limit')
+    parser.add_argument('--batch-size', type=int, action='store', default=50, help='IDs per request')
+    parser.add_argument('--latency', type=float, action='store', default=0.2, help='Mock server latency (seconds)')
+    parser.add_argument('--error-rate', type=float, action='store', default=0.05, help='Mock server 503 rate')
+    parser.add_argument('--rate-limit-rate', type=float, action='store', default=0.05, help='Mock server 429 rate')
+    args = parser.parse_args()
+
+    ids = makeIDs(args.ids, args.missing)
+    print("threads\tseconds\tids_per_sec\tfetched\tfailed\twrong_seq\tnot_returned\trequests\tinjected_5xx\tinjected_429")
+    for threads in [int(t) for t in args.threads.split(',')]:
+        server, url = startMockServer(latency=args.latency, errorRate=args.error_rate, rateLimitRate=args.rate_limit_rate)
+        elapsed, fetched, failed, wrong, missing = runFetch(url, ids, threads, args.rate, args.batch_size)
+        stats = server.stats
+        server.shutdown()
+        server.server_close()
+        print(f"{threads}\t{elapsed:.2f}\t{len(ids)/elapsed:.0f}\t{fetched}\t{failed}\t{wrong}\t{missing}\t{stats['requests']}\t{stats['errors']}\t{stats['rate_limited']}")
+        continue
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Benchmark of the single pass Newick relabelling in
+ensemblGeneFamilyHomologyFileParser.py against the old
+str.replace() per leaf approach on large random families.
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+from ete3 import Tree
+
+sys.path.insert(0, (Path(__file__).resolve().parents[1] / 'scripts').as_posix())
+from ensemblGeneFamilyHomologyFileParser import makeLabelledTrees
+
+SPECIES = ['canis_lupus_familiaris', 'canis_lupus_dingo', 'felis_catus', 'lynx_canadensis', 'mus_musculus', 'rattus_norvegicus', 'ursus_maritimus', 'vulpes_vulpes']
+
+
+def legacyLabelledTrees(newick, df):
+    """The per leaf str.replace() loops that makeLabelledTrees() replaced"""
+    scientificNameTree = newick
+    geneNameTree = newick
+    for pid, sn, gene in zip(df['ProteinID'], df['Species'], df['Gene']):
+        scientificNameTree = scientificNameTree.replace(pid, sn)
+        geneNameTree = geneNameTree.replace(pid, gene)
+        continue
+    commonNameTree = scientificNameTree
+    for sn, cn in dict(zip(df['Species'], df['CommonName'])).items():
+        commonNameTree = commonNameTree.replace(sn, cn)
+        continue
+    return {'ProteinID': newick, 'ScientificName': scientificNameTree, 'CommonName': commonNameTree, 'GeneName': geneNameTree}
+
+
+def makeFamily(leaves, seed):
+    rng = random.Random(seed)
+    proteinIDs = [f"ENSP{n:011d}" for n in range(leaves)]
+    species = [rng.choice(SPECIES) for _ in proteinIDs]
+    df = pd.DataFrame({
+        'ProteinID': proteinIDs,
+        'Species': species,
+        'CommonName': [sn[::-1] for sn in species],
+        'Gene': [f"GENE{rng.randint(1, 50)}" for _ in proteinIDs],
+    })
+    tree = Tree()
+    tree.populate(leaves, names_library=proteinIDs, random_branches=True)
+    return tree.write(), df
+
+
+def timeit(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        continue
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Newick leaf relabelling')
+    parser.add_argument(
+        '--leaves',
+        type=str,
+        action='store',
+        default='100,1000,5000',
+        help='Comma separated list of family sizes to benchmark',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        action='store',
+        default=1,
+        help='Random seed for the generated families',
+    )
+    args = parser.parse_args()
+    print("leaves\tlegacy_sec\tsingle_pass_sec\tspeedup\tsame_output")
+    for leaves in [int(n) for n in args.leaves.split(',')]:
+        newick, df = makeFamily(leaves, args.seed)
+        legacy = timeit(legacyLabelledTrees, newick, df)
+        singlePass = timeit(makeLabelledTrees, newick, df)
+        sameOutput = legacyLabelledTrees(newick, df) == makeLabelledTrees(newick, df)
+        print(f"{leaves}\t{legacy:.4f}\t{singlePass:.4f}\t{legacy/singlePass:.1f}x\t{sameOutput}")
+        continue
+    return
+
+
+if __name__ == '__main__':
+    main()
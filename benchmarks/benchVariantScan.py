@@ -0,0 +1,134 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Benchmark of the NumPy column scan in identifyVariantsOfInterest.py
+against the old per column Biopython loop on random alignments with
+thousands of columns. Both must report the same variants.
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from Bio.Align import MultipleSeqAlignment
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+sys.path.insert(0, (Path(__file__).resolve().parents[1] / 'scripts').as_posix())
+from identifyVariantsOfInterest import findUniqueVariants
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+ORDERS = ['carnivora', 'rodentia', 'primates', 'artiodactyla']
+
+
+def legacyUniqueVariants(aln):
+    """The per column loop that findUniqueVariants() replaced"""
+    results = []
+    for i in range(len(aln[0].seq)):
+        pos_data = aln[:, i]
+        sample_names = [n.id for n in aln[:, i:i]]
+        if (pos_data.count("-")/len(pos_data)) > 0.5:
+            continue
+        elif len(list(set(pos_data))) > 2:
+            continue
+        else:
+            aa_to_find = [a for a in pos_data if (pos_data.count(a) == 1) and (pos_data != '-')]
+            if len(aa_to_find) == 0:
+                continue
+            aa_to_find_pos = pos_data.rindex(aa_to_find[0])
+            if pos_data[aa_to_find_pos] == '-':
+                continue
+            elif 'primate' in sample_names[aa_to_find_pos]:
+                continue
+            results.append([sample_names[aa_to_find_pos], i, pos_data[aa_to_find_pos], pos_data])
+            continue
+    return results
+
+
+def makeAlignment(samples, columns, seed):
+    """Random alignment mixing conserved columns, single sample
+    substitutions, gappy columns and noisy columns"""
+    rng = random.Random(seed)
+    rows = [[] for _ in range(samples)]
+    for _ in range(columns):
+        roll = rng.random()
+        base = rng.choice(AMINO_ACIDS)
+        column = [base] * samples
+        if roll < 0.3:
+            column[rng.randrange(samples)] = rng.choice(AMINO_ACIDS + '-')
+        elif roll < 0.4:
+            column = [rng.choice((base, '-')) for _ in range(samples)]
+        elif roll < 0.6:
+            column = [rng.choice(AMINO_ACIDS + '-') for _ in range(samples)]
+        for row, residue in zip(rows, column):
+            row.append(residue)
+            continue
+        continue
+    records = [SeqRecord(Seq(''.join(row)), id=f"GENE_sample{n}_{ORDERS[n % len(ORDERS)]}_ENSP{n:011d}") for n, row in enumerate(rows)]
+    return MultipleSeqAlignment(records)
+
+
+def alignmentMatrix(aln):
+    """Return the sample names + a (samples x columns) uint8 matrix of an
+    in memory Biopython alignment"""
+    names = [record.id for record in aln]
+    matrix = np.frombuffer(''.join(str(record.seq) for record in aln).encode(), dtype=np.uint8)
+    return names, matrix.reshape(len(names), -1)
+
+
+def numpyUniqueVariants(aln):
+    return findUniqueVariants(*alignmentMatrix(aln))
+
+
+def timeit(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        continue
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the alignment variant scan')
+    parser.add_argument(
+        '--columns',
+        type=str,
+        action='store',
+        default='1000,10000,50000',
+        help='Comma separated list of alignment lengths to benchmark',
+    )
+    parser.add_argument(
+        '--samples',
+        type=int,
+        action='store',
+        default=40,
+        help='Number of sequences in each alignment',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        action='store',
+        default=1,
+        help='Random seed for the generated alignments',
+    )
+    args = parser.parse_args()
+    print("columns\tlegacy_sec\tnumpy_sec\tspeedup\tvariants\tsame_output")
+    for columns in [int(n) for n in args.columns.split(',')]:
+        aln = makeAlignment(args.samples, columns, args.seed)
+        legacy = timeit(legacyUniqueVariants, aln, repeat=1)
+        vectorized = timeit(numpyUniqueVariants, aln)
+        legacyResults = legacyUniqueVariants(aln)
+        sameOutput = legacyResults == numpyUniqueVariants(aln)
+        print(f"{columns}\t{legacy:.4f}\t{vectorized:.4f}\t{legacy/vectorized:.1f}x\t{len(legacyResults)}\t{sameOutput}")
+        continue
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Local stand-in for the Ensembl REST /sequence/id (+ /info/data) endpoints so
+fetchEnsemblSequences.py can be run and timed without touching
+rest.ensembl.org. Sequences are generated deterministically from
+the stable ID. IDs containing "MISSING" are treated as unknown, and
+like Ensembl a POST containing an unknown ID is rejected with a 400.
+Latency, 5xx errors and 429 rate limit responses (with Retry-After)
+can be injected to exercise the fetcher's retry logic.
+
+Run it on its own:
+    python mockEnsemblServer.py --port 8765 --latency 0.1 --error-rate 0.1
+and point the fetcher at it with --server http://127.0.0.1:8765
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENSEMBL_MAX_POST_IDS = 50
+MOCK_RELEASE = 102
+
+
+def isProteinID(stableID):
+    """Ensembl stable IDs end their letter prefix with the feature
+    type -- G(ene), T(ranscript), P(rotein) or E(xon)"""
+    prefix = re.match(r'([A-Za-z]+)\d', stableID)
+    return bool(prefix) and prefix.group(1).upper().endswith('P')
+
+
+def fakeSequence(stableID, length=None):
+    """Deterministic pseudo sequence for a stable ID -- protein IDs
+    get amino acids, everything else gets nucleotides"""
+    digest = hashlib.sha256(stableID.encode()).digest()
+    alphabet = 'ACDEFGHIKLMNPQRSTVWY' if isProteinID(stableID) else 'ACGT'
+    length = length or (200 + digest[0] * 8)
+    return ''.join(alphabet[digest[i % len(digest)] % len(alphabet)] for i in range(length))
+
+
+def sequenceRecord(stableID):
+    return {
+        'id': stableID,
+        'query': stableID,
+        'desc': f'chromosome:Mock_1.0:1:1:{len(fakeSequence(stableID))}:1',
+        'molecule': 'protein' if isProteinID(stableID) else 'dna',
+        'seq': fakeSequence(stableID),
+        'version': 1,
+    }
+
+
+class MockEnsemblServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, errorRate=0.0, rateLimitRate=0.0, retryAfter=0.1, seed=1):
+        super().__init__(address, MockEnsemblHandler)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.rateLimitRate = rateLimitRate
+        self.retryAfter = retryAfter
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0}
+        return
+
+    def injectFault(self):
+        """Return 'error', 'rate_limited' or None for the next request"""
+        with self.lock:
+            self.stats['requests'] += 1
+            roll = self.rng.random()
+            if roll < self.errorRate:
+                self.stats['errors'] += 1
+                return 'error'
+            elif roll < self.errorRate + self.rateLimitRate:
+                self.stats['rate_limited'] += 1
+                return 'rate_limited'
+        return None
+
+
+class MockEnsemblHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def handleFault(self):
+        """Sleep for the configured latency and send an injected
+        error response. Returns True if a response was sent."""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        fault = self.server.injectFault()
+        if fault == 'error':
+            self.sendJSON(503, {'error': 'Service temporarily unavailable'})
+            return True
+        elif fault == 'rate_limited':
+            self.sendJSON(429, {'error': 'Too many requests'}, {'Retry-After': str(self.server.retryAfter)})
+            return True
+        return False
+
+    def sendJSON(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def do_GET(self):
+        if self.handleFault():
+            return
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/info/data':
+            self.sendJSON(200, {'releases': [MOCK_RELEASE]})
+            return
+        elif path.startswith('/sequence/id/'):
+            stableID = path.rsplit('/', 1)[-1]
+            if 'MISSING' in stableID:
+                self.sendJSON(400, {'error': f"ID '{stableID}' not found"})
+            else:
+                self.sendJSON(200, sequenceRecord(stableID))
+            return
+        self.sendJSON(404, {'error': 'page not found'})
+        return
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if self.handleFault():
+            return
+        if self.path.split('?')[0].rstrip('/') != '/sequence/id':
+            self.sendJSON(404, {'error': 'page not found'})
+            return
+        ids = payload.get('ids', [])
+        if len(ids) > ENSEMBL_MAX_POST_IDS:
+            self.sendJSON(400, {'error': f'POST message too large. You have submitted {len(ids)} IDs. Please limit your submissions to {ENSEMBL_MAX_POST_IDS} IDs'})
+            return
+        missing = [i for i in ids if 'MISSING' in i]
+        if missing:
+            self.sendJSON(400, {'error': f"ID '{missing[0]}' not found"})
+            return
+        self.sendJSON(200, [sequenceRecord(i) for i in ids])
+        return
+
+
+def startMockServer(port=0, **faults):
+    """Start the mock server in a background thread. Returns the
+    server and its base URL -- call server.shutdown() when done.
+    faults are passed through to MockEnsemblServer."""
+    server = MockEnsemblServer(('127.0.0.1', port), **faults)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the Ensembl REST /sequence/id endpoint')
+    parser.add_argument(
+        '--port',
+        type=int,
+        action='store',
+        default=8765,
+        help='Port to listen on',
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        action='store',
+        default=0.0,
+        help='Seconds added to every response',
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        action='store',
+        default=0.0,
+        help='Fraction of requests answered with a 503',
+    )
+    parser.add_argument(
+        '--rate-limit-rate',
+        type=float,
+        action='store',
+        default=0.0,
+        help='Fraction of requests answered with a 429 + Retry-After',
+    )
+    args = parser.parse_args()
+    server = MockEnsemblServer(('127.0.0.1', args.port), latency=args.latency, errorRate=args.error_rate, rateLimitRate=args.rate_limit_rate)
+    print(f"Mock Ensembl REST server listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Benchmark suite for the three scripts. Seeded synthetic inputs are
+generated once per run (see syntheticData.py) and each script is timed
+end to end as a subprocess:
+
+    parser            ensemblGeneFamilyHomologyFileParser.py, 1 process
+    parser_workers    the same with --workers
+    parser_index      the same through a prebuilt family index
+    scanner_build     identifyVariantsOfInterest.py from a cold matrix cache
+    scanner_cached    the same reusing the cached matrix
+    scanner_contrasts carnivora + primates:rodentia clade contrasts
+    fetch             fetchEnsemblSequences.py against the local mock REST
+                      server with latency and injected 5xx/429 faults
+
+Results are written as JSON (commit, machine, sizes, seconds per repeat)
+to benchmarks/results/ so runs can be compared between commits:
+    python runBenchmarks.py --size small
+    python runBenchmarks.py --size small --compare results/<older run>.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from mockEnsemblServer import startMockServer
+import syntheticData
+
+REPO = Path(__file__).resolve().parents[1]
+SCRIPTS = REPO / 'scripts'
+SPECIES_TABLE = REPO / 'input_files' / 'speciesNameConverter.xlsx'
+BENCHMARKS = ['parser', 'parser_workers', 'parser_index', 'scanner_build', 'scanner_cached', 'scanner_contrasts', 'fetch']
+
+SIZES = {
+    'small': dict(families=500, familySize=20, treeDepth=6, genes=100, lookup=20, samples=30, columns=50000, fetchRows=200),
+    'medium': dict(families=5000, familySize=40, treeDepth=10, genes=500, lookup=50, samples=60, columns=500000, fetchRows=1000),
+    'large': dict(families=20000, familySize=80, treeDepth=16, genes=2000, lookup=200, samples=100, columns=5000000, fetchRows=5000),
+}
+
+
+def gitInfo():
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {'commit': git('rev-parse', 'HEAD'), 'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def runScript(script, args):
+    """Run a script quietly, returning its wall time in seconds"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, (SCRIPTS / script).as_posix(), *[str(a) for a in args]], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{script} {' '.join(str(a) for a in args)} failed:\n{result.stderr}")
+    return elapsed
+
+
+def timeRepeats(repeat, run, setup=None):
+    """Time run() repeat times, calling setup() untimed before each"""
+    seconds = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        seconds.append(round(run(), 4))
+        continue
+    return {'seconds': seconds, 'best': min(seconds), 'median': round(statistics.median(seconds), 4)}
+
+
+def removePaths(*paths):
+    for path in paths:
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            os.remove(path)
+        continue
+    return
+
+
+def makeInputs(workdir, size, seed):
+    inputs = {
+        'emf': workdir / 'synthetic.emf',
+        'genes': workdir / 'genes.txt',
+        'alignment': workdir / 'synthetic.fasta',
+        'fetch': workdir / 'fetch_input.tsv',
+    }
+    syntheticData.writeSyntheticEmf(inputs['emf'], size['families'], size['familySize'], size['treeDepth'], size['genes'], seed)
+    syntheticData.writeGeneList(inputs['genes'], size['lookup'], size['genes'], seed)
+    syntheticData.writeSyntheticAlignment(inputs['alignment'], size['samples'], size['columns'], seed)
+    syntheticData.writeFetchInput(inputs['fetch'], size['fetchRows'], seed=seed)
+    return inputs
+
+
+def runSuite(selected, inputs, workdir, repeat, workers, latency):
+    results = {}
+    out = workdir / 'out'
+    parserArgs = ['-i', inputs['emf'], '-g', inputs['genes'], '-s', SPECIES_TABLE, '-o', out]
+    clearOut = lambda: removePaths(out)
+    if 'parser' in selected:
+        results['parser'] = timeRepeats(repeat, lambda: runScript('ensemblGeneFamilyHomologyFileParser.py', parserArgs), clearOut)
+    if 'parser_workers' in selected:
+        results['parser_workers'] = timeRepeats(repeat, lambda: runScript('ensemblGeneFamilyHomologyFileParser.py', parserArgs + ['--workers', workers]), clearOut)
+    if 'parser_index' in selected:
+        index = workdir / 'synthetic.emf.idx.sqlite'
+        removePaths(index)
+        results['parser_index_build'] = timeRepeats(1, lambda: runScript('ensemblGeneFamilyHomologyFileParser.py', ['index', '-i', inputs['emf'], '--index', index]))
+        results['parser_index'] = timeRepeats(repeat, lambda: runScript('ensemblGeneFamilyHomologyFileParser.py', parserArgs + ['--index', index]), clearOut)
+
+    cacheDir = workdir / 'matrix_cache'
+    scannerArgs = ['-i', inputs['alignment'], '-o', workdir / 'variants.tsv', '--cache-dir', cacheDir]
+    if 'scanner_build' in selected:
+        results['scanner_build'] = timeRepeats(repeat, lambda: runScript('identifyVariantsOfInterest.py', scannerArgs), lambda: removePaths(cacheDir))
+    if 'scanner_cached' in selected:
+        runScript('identifyVariantsOfInterest.py', scannerArgs)
+        results['scanner_cached'] = timeRepeats(repeat, lambda: runScript('identifyVariantsOfInterest.py', scannerArgs))
+    if 'scanner_contrasts' in selected:
+        contrastArgs = scannerArgs + ['--groups', SPECIES_TABLE, '--group-columns', 'order', '--contrast', 'carnivora', 'primates:rodentia']
+        runScript('identifyVariantsOfInterest.py', contrastArgs)
+        results['scanner_contrasts'] = timeRepeats(repeat, lambda: runScript('identifyVariantsOfInterest.py', contrastArgs))
+
+    if 'fetch' in selected:
+        server, url = startMockServer(latency=latency, errorRate=0.02, rateLimitRate=0.02, retryAfter=0.05)
+        fetchArgs = ['-i', inputs['fetch'], '-g', 'SYN1', '-o', out, '--server', url, '--no-cache', '--overwrite']
+        try:
+            results['fetch'] = timeRepeats(repeat, lambda: runScript('fetchEnsemblSequences.py', fetchArgs), clearOut)
+        finally:
+            server.shutdown()
+            server.server_close()
+        results['fetch']['mock_server'] = server.stats
+    return results
+
+
+def compareResults(old, new):
+    """Print best times of two result files side by side"""
+    print(f"benchmark\t{(old.get('commit') or 'old')[:10]}\t{(new.get('commit') or 'new')[:10]}\tratio")
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['best'], result['best']
+        ratio = after / before if before else float('nan')
+        flag = '  <-- slower' if ratio > 1.1 else ''
+        print(f"{name}\t{before:.3f}\t{after:.3f}\t{ratio:.2f}x{flag}")
+        continue
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the three scripts on seeded synthetic inputs')
+    parser.add_argument(
+        '--size',
+        type=str,
+        action='store',
+        choices=list(SIZES),
+        default='small',
+        help='Input size preset [default: small]',
+    )
+    parser.add_argument(
+        '--only',
+        type=str,
+        action='store',
+        nargs='+',
+        choices=BENCHMARKS,
+        default=BENCHMARKS,
+        help='Benchmarks to run [default: all]',
+    )
+    parser.add_argument('--repeat', type=int, action='store', default=3, help='Timed runs per benchmark')
+    parser.add_argument('--workers', type=int, action='store', default=4, help='--workers for parser_workers')
+    parser.add_argument('--latency', type=float, action='store', default=0.05, help='Mock server latency (seconds)')
+    parser.add_argument('--seed', type=int, action='store', default=1, help='Random seed for the synthetic inputs')
+    parser.add_argument(
+        '-o',
+        '--output',
+        type=str,
+        action='store',
+        default=(Path(__file__).resolve().parent / 'results').as_posix(),
+        help='Directory the JSON results are written to [default: benchmarks/results]',
+    )
+    parser.add_argument(
+        '--compare',
+        type=str,
+        action='store',
+        default=None,
+        help='Earlier results JSON to compare this run against',
+    )
+    parser.add_argument(
+        '--workdir',
+        type=str,
+        action='store',
+        default=None,
+        help='Directory for the synthetic inputs + outputs [default: a temporary directory]',
+    )
+    args = parser.parse_args()
+    size = SIZES[args.size]
+
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='benchmarks_'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    try:
+        start = time.perf_counter()
+        inputs = makeInputs(workdir, size, args.seed)
+        print(f"Synthetic '{args.size}' inputs written in {time.perf_counter() - start:.1f}s")
+        results = runSuite(set(args.only), inputs, workdir, args.repeat, args.workers, args.latency)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        **gitInfo(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'size': args.size,
+        'seed': args.seed,
+        'params': {**size, 'repeat': args.repeat, 'workers': args.workers, 'latency': args.latency},
+        'results': results,
+    }
+    OUTPUT = Path(args.output)
+    OUTPUT.mkdir(parents=True, exist_ok=True)
+    reportFile = OUTPUT / f"{time.strftime('%Y%m%d-%H%M%S')}_{(report['commit'] or 'nogit')[:10]}_{args.size}.json"
+    reportFile.write_text(json.dumps(report, indent=2))
+    print("benchmark\tbest_sec\tmedian_sec")
+    for name, result in results.items():
+        print(f"{name}\t{result['best']:.3f}\t{result['median']:.3f}")
+        continue
+    print(f"Results written to {reportFile}")
+    if args.compare:
+        print()
+        compareResults(json.loads(Path(args.compare).read_text()), report)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Seeded generators for synthetic benchmark inputs. The same arguments
+always produce byte-identical files.
+
+    writeSyntheticEmf        -- Compara EMF gene family file sized by family
+                                count, family size and tree depth
+    writeGeneList            -- gene names to look up in that EMF file
+    writeSyntheticAlignment  -- multi-FASTA alignment sized by samples x columns
+    writeFetchInput          -- fetchEnsemblSequences.py input table
+
+Species come from input_files/speciesNameConverter.xlsx so the species
+filter, common names and orders work like they do on real data. A few
+species that are not in the table are mixed into the EMF families to
+exercise the species filter.
+
+Run on its own to write a set of inputs:
+    python syntheticData.py -o /tmp/synthetic --families 2000 --family-size 40
+"""
+import argparse
+import random
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SPECIES_TABLE = Path(__file__).resolve().parents[1] / 'input_files' / 'speciesNameConverter.xlsx'
+EXTRA_SPECIES = ['gallus_gallus', 'danio_rerio', 'xenopus_tropicalis']
+AMINO_ACIDS = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype=np.uint8)
+GAP = ord('-')
+
+
+def loadSpeciesTable():
+    return pd.read_excel(SPECIES_TABLE, engine='openpyxl')
+
+
+def geneNames(count):
+    return [f"SYN{n}" for n in range(count)]
+
+
+########################## EMF Files ##########################
+def randomNewick(leaves, depth, rng):
+    """Random tree over leaves no deeper than depth. Once the depth limit
+    is reached the remaining leaves hang off a single polytomy."""
+    if len(leaves) == 1:
+        return f"{leaves[0]}:{rng.random():.5f}"
+    if depth <= 1:
+        children = [f"{leaf}:{rng.random():.5f}" for leaf in leaves]
+    else:
+        cut = rng.randint(1, len(leaves) - 1)
+        children = [randomNewick(leaves[:cut], depth - 1, rng), randomNewick(leaves[cut:], depth - 1, rng)]
+    return f"({','.join(children)}):{rng.random():.5f}"
+
+
+def writeSyntheticEmf(path, families=1000, familySize=30, treeDepth=8, genes=200, seed=1):
+    """Write a Compara EMF file of families gene families. Family sizes vary
+    around familySize, most members carry the family's gene name and the
+    rest another gene, a two word name or no name at all."""
+    rng = random.Random(seed)
+    species = list(loadSpeciesTable()['scientific_name']) + EXTRA_SPECIES
+    names = geneNames(genes)
+    memberID = 0
+    with open(path, 'w') as oh:
+        oh.write('##FORMAT (compara)\n')
+        for family in range(families):
+            familyGene = names[family % genes]
+            size = max(2, int(rng.gauss(familySize, familySize / 4)))
+            proteinIDs = []
+            for k in range(size):
+                memberID += 1
+                proteinID = f"ENSSYNP{memberID:011d}"
+                proteinIDs.append(proteinID)
+                roll = rng.random()
+                if roll < 0.8:
+                    gene = familyGene
+                elif roll < 0.9:
+                    gene = rng.choice(names)
+                elif roll < 0.93:
+                    gene = f"{familyGene} like"
+                else:
+                    gene = None
+                row = ['SEQ', rng.choice(species), proteinID, str(rng.randint(1, 22)), str(k * 1000), str(k * 1000 + 900), '1', f"ENSSYNG{memberID:011d}"]
+                if gene:
+                    row.append(gene)
+                oh.write(' '.join(row) + '\n')
+                continue
+            rng.shuffle(proteinIDs)
+            oh.write(f"DATA\n{randomNewick(proteinIDs, treeDepth, rng)};\n//\n\n")
+            continue
+    return
+
+
+def writeGeneList(path, count, genes=200, seed=1):
+    """count gene names of a writeSyntheticEmf() file plus one that is in no family"""
+    rng = random.Random(seed)
+    names = rng.sample(geneNames(genes), min(count, genes)) + ['NOT_A_GENE']
+    Path(path).write_text(''.join(f"{n}\n" for n in names))
+    return
+
+
+########################## Alignments ##########################
+def writeSyntheticAlignment(path, samples=40, columns=100000, seed=1, lineWidth=60):
+    """Write a random protein alignment mixing conserved columns, single
+    sample substitutions, carnivore specific substitutions, gappy columns
+    and noisy columns. Headers follow the fetcher's
+    gene_commonName_order_proteinID layout."""
+    rng = np.random.default_rng(seed)
+    table = loadSpeciesTable()
+    rows = table.iloc[np.arange(samples) % len(table)]
+    names = [f"SYN_{cn}_{order}_ENSSYNP{n:011d}" for n, (cn, order) in enumerate(zip(rows['common_name'], rows['order']))]
+    carnivores = (rows['order'] == 'carnivora').to_numpy()
+    matrix = np.repeat(rng.choice(AMINO_ACIDS, columns)[None, :], samples, axis=0)
+    kind = rng.random(columns)
+    # Single sample substitutions
+    cols = np.flatnonzero(kind < 0.25)
+    matrix[rng.integers(0, samples, len(cols)), cols] = rng.choice(np.append(AMINO_ACIDS, GAP), len(cols))
+    # Carnivore specific substitutions
+    cols = np.flatnonzero((kind >= 0.25) & (kind < 0.35))
+    matrix[np.ix_(carnivores, cols)] = rng.choice(AMINO_ACIDS, len(cols))[None, :]
+    # Gappy columns
+    cols = np.flatnonzero((kind >= 0.35) & (kind < 0.45))
+    gaps = rng.random((samples, len(cols))) < 0.6
+    matrix[:, cols] = np.where(gaps, GAP, matrix[:, cols])
+    # Noisy columns
+    cols = np.flatnonzero((kind >= 0.45) & (kind < 0.6))
+    matrix[:, cols] = rng.choice(AMINO_ACIDS, (samples, len(cols)))
+    with open(path, 'w') as oh:
+        for name, row in zip(names, matrix):
+            seq = row.tobytes().decode()
+            oh.write(f">{name}\n")
+            oh.write('\n'.join([seq[i:i+lineWidth] for i in range(0, len(seq), lineWidth)]) + '\n')
+            continue
+    return
+
+
+########################## Fetch Inputs ##########################
+def writeFetchInput(path, rows=500, missing=5, gene='SYN1', seed=1):
+    """fetchEnsemblSequences.py input with rows synthetic gene/protein ID
+    pairs, missing of which the mock server does not know"""
+    rng = random.Random(seed)
+    table = loadSpeciesTable()
+    records = []
+    for n in range(rows + missing):
+        species = table.iloc[rng.randrange(len(table))]
+        stable = f"MISSING{n:05d}" if n >= rows else f"{n:011d}"
+        records.append({
+            'Gene': gene if rng.random() < 0.9 else None,
+            'Species': species['scientific_name'],
+            'CommonName': species['common_name'],
+            'Order': species['order'],
+            'SpeciesCopyNumber': 1,
+            'OrderCopyNumber': 1,
+            'Chunk': f"{gene}_chunk_1",
+            'GeneID': f"ENSSYNG{stable}",
+            'ProteinID': f"ENSSYNP{stable}",
+        })
+        continue
+    pd.DataFrame(records).to_csv(path, sep='\t', index=False)
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write seeded synthetic benchmark inputs')
+    parser.add_argument('-o', '--output', type=str, action='store', required=True, help='Output directory')
+    parser.add_argument('--families', type=int, action='store', default=1000, help='Number of EMF gene families')
+    parser.add_argument('--family-size', type=int, action='store', default=30, help='Mean members per family')
+    parser.add_argument('--tree-depth', type=int, action='store', default=8, help='Maximum depth of the family trees')
+    parser.add_argument('--genes', type=int, action='store', default=200, help='Number of distinct gene names')
+    parser.add_argument('--lookup', type=int, action='store', default=20, help='Number of genes in the gene list')
+    parser.add_argument('--samples', type=int, action='store', default=40, help='Alignment samples')
+    parser.add_argument('--columns', type=int, action='store', default=100000, help='Alignment columns')
+    parser.add_argument('--fetch-rows', type=int, action='store', default=500, help='Rows in the fetch input')
+    parser.add_argument('--seed', type=int, action='store', default=1, help='Random seed')
+    args = parser.parse_args()
+    OUTPUT = Path(args.output)
+    OUTPUT.mkdir(parents=True, exist_ok=True)
+    writeSyntheticEmf(OUTPUT / 'synthetic.emf', args.families, args.family_size, args.tree_depth, args.genes, args.seed)
+    writeGeneList(OUTPUT / 'genes.txt', args.lookup, args.genes, args.seed)
+    writeSyntheticAlignment(OUTPUT / 'synthetic.fasta', args.samples, args.columns, args.seed)
+    writeFetchInput(OUTPUT / 'fetch_input.tsv', args.fetch_rows, seed=args.seed)
+    print(f"Synthetic inputs written to {OUTPUT}")
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+FASTA alignments as memory-mapped (samples x columns) uint8 matrices.
+
+The first time an alignment is read it is converted, one line at a time,
+into a cache written next to it:
+    <alignment>.matrix.npy    -- row-major uint8 matrix, one row per sample
+    <alignment>.names.txt     -- sample names in row order
+    <alignment>.source.json   -- path, size + mtime of the alignment it was built from
+In a shared cacheDir the file names also carry a hash of the alignment's
+resolved path, so alignments with the same name in different directories
+get their own cache. Later reads memory map the cached matrix without
+reparsing the FASTA file until the alignment changes. Only the pages of the columns being
+looked at are read from disk, so scans can run in column windows with
+bounded memory however long the alignment is.
+"""
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from fastaIndex import fileStats, isGzipFile, scanFasta
+from stageMetrics import NULL_METRICS
+
+CHUNK_BYTES = 1 << 20
+
+
+def matrixCachePaths(alignmentPath, cacheDir=None):
+    """(matrix, names, source) cache files of an alignment"""
+    alignmentPath = Path(alignmentPath)
+    if cacheDir is None:
+        stem = alignmentPath.parent / alignmentPath.name
+    else:
+        pathKey = hashlib.sha1(alignmentPath.resolve().as_posix().encode()).hexdigest()[:10]
+        stem = Path(cacheDir) / f"{alignmentPath.name}.{pathKey}"
+    return Path(f"{stem}.matrix.npy"), Path(f"{stem}.names.txt"), Path(f"{stem}.source.json")
+
+
+def matrixCacheIsCurrent(alignmentPath, matrixPath, namesPath, sourcePath):
+    """The cache exists and was built from this version of this alignment"""
+    if not (matrixPath.exists() and namesPath.exists() and sourcePath.exists()):
+        return False
+    try:
+        return json.loads(sourcePath.read_text()) == fileStats(alignmentPath)
+    except ValueError:
+        return False
+
+
+def openAlignment(alignmentPath):
+    opener = gzip.open if isGzipFile(alignmentPath) else open
+    return opener(alignmentPath, 'rb')
+
+
+def copyChunk(matrix, row, column, chunk):
+    """Copy the joined sequence lines in chunk into matrix[row] from column on,
+    returning the next free column"""
+    if not chunk:
+        return column
+    data = np.frombuffer(b''.join(chunk), dtype=np.uint8)
+    matrix[row, column:column+len(data)] = data
+    return column + len(data)
+
+
+def buildAlignmentMatrix(alignmentPath, matrixPath, namesPath, sourcePath):
+    """Convert a FASTA alignment into the cached matrix + names files.
+    The first pass collects names + lengths, the second copies each
+    sequence line straight into the memory-mapped matrix. The source
+    file is written last, so an interrupted build is never used."""
+    if sourcePath.exists():
+        os.remove(sourcePath)
+    with openAlignment(alignmentPath) as fh:
+        records = [(header.split()[0] if header.strip() else '', length) for _, header, length, _, _, _ in scanFasta(fh)]
+    if not records:
+        raise ValueError(f"No sequences found in {alignmentPath}")
+    lengths = set(length for _, length in records)
+    if len(lengths) > 1:
+        raise ValueError(f"Sequences in {alignmentPath} must all be the same length -- found lengths {sorted(lengths)}")
+    matrixPath.parent.mkdir(parents=True, exist_ok=True)
+    tmpPath = matrixPath.with_name(f"{matrixPath.name}.tmp.npy")
+    matrix = np.lib.format.open_memmap(tmpPath, mode='w+', dtype=np.uint8, shape=(len(records), lengths.pop()))
+    # Sequence lines are gathered into ~1 MB chunks before being copied in
+    row, column = -1, 0
+    chunk, chunkSize = [], 0
+    with openAlignment(alignmentPath) as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                column = copyChunk(matrix, row, column, chunk)
+                row, column = row + 1, 0
+                chunk, chunkSize = [], 0
+                continue
+            line = line.rstrip(b'\r\n')
+            if row < 0 or not line:
+                continue
+            chunk.append(line)
+            chunkSize += len(line)
+            if chunkSize >= CHUNK_BYTES:
+                column = copyChunk(matrix, row, column, chunk)
+                chunk, chunkSize = [], 0
+            continue
+    copyChunk(matrix, row, column, chunk)
+    matrix.flush()
+    del matrix
+    namesPath.write_text(''.join(f"{name}\n" for name, _ in records))
+    os.replace(tmpPath, matrixPath)
+    sourcePath.write_text(json.dumps(fileStats(alignmentPath)))
+    return
+
+
+def loadAlignmentMatrix(alignmentPath, cacheDir=None, metrics=NULL_METRICS):
+    """Return the sample names + a read-only memory-mapped uint8 matrix of
+    the alignment, (re)building the cache when missing or out of date"""
+    matrixPath, namesPath, sourcePath = matrixCachePaths(alignmentPath, cacheDir)
+    if not matrixCacheIsCurrent(alignmentPath, matrixPath, namesPath, sourcePath):
+        with metrics.stage('build_matrix'):
+            buildAlignmentMatrix(alignmentPath, matrixPath, namesPath, sourcePath)
+    names = namesPath.read_text().splitlines()
+    return names, np.load(matrixPath, mmap_mode='r')
+
+
+def columnWindows(matrix, windowSize):
+    """Yield (first column, matrix[:, window]) for consecutive windows"""
+    for start in range(0, matrix.shape[1], windowSize):
+        yield start, matrix[:, start:start+windowSize]
+        continue
+    return
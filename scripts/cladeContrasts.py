@@ -0,0 +1,183 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Lineage specific substitution scans for clade contrasts.
+
+A species -> group table (e.g. speciesNameConverter.xlsx, keyed by
+common_name with an order column) is read once. For each alignment it is
+compiled into one boolean row mask per group by matching the table keys
+against the sample names. A contrast is "foreground" (against every other
+sample) or "foreground:background". All contrasts are evaluated together:
+every residue of a column window is counted once per group mask with a
+single matrix product, and each contrast is then resolved from those
+counts. N contrasts cost one pass over the alignment, not N.
+
+A column is a hit for a contrast when, over the foreground + background rows:
+    1. the gap fraction is <= maxGapFraction
+    2. the number of different symbols (gaps count) is <= maxStates
+    3. every non-gap foreground residue is the same residue
+    4. no background sample carries that residue (and at least one is not a gap)
+"""
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+GAP = ord('-')
+CONTRAST_COLUMNS = ['contrast', 'position', 'foregroundAA', 'backgroundAAs', 'foregroundSamples', 'backgroundSamples', 'allSampleBases']
+
+Contrast = namedtuple('Contrast', ['label', 'foreground', 'background'])
+CompiledContrast = namedtuple('CompiledContrast', ['label', 'foregroundMask', 'backgroundMask'])
+
+
+########################## Group Table ##########################
+def readGroupTable(path, keyColumn='common_name', groupColumns=None):
+    """Return {key: (group, ...)} from an xlsx/tsv/csv table. keyColumn falls
+    back to the first column, groupColumns default to every other column.
+    pandas is only imported here, so scans without --groups never load it."""
+    import pandas as pd
+    path = Path(path)
+    if path.suffix in ('.xlsx', '.xls'):
+        df = pd.read_excel(path, dtype=str)
+    else:
+        df = pd.read_csv(path, sep=',' if path.suffix == '.csv' else '\t', dtype=str)
+    if keyColumn not in df.columns:
+        keyColumn = df.columns[0]
+    groupColumns = groupColumns or [c for c in df.columns if c != keyColumn]
+    missing = [c for c in groupColumns if c not in df.columns]
+    if missing:
+        raise ValueError(f"Group column(s) {missing} not found in {path} -- columns are {list(df.columns)}")
+    groupTable = {}
+    for row in df[[keyColumn] + groupColumns].itertuples(index=False):
+        if pd.isna(row[0]):
+            continue
+        groupTable[row[0].strip().lower()] = tuple(str(g).strip() for g in row[1:] if not pd.isna(g))
+        continue
+    return groupTable
+
+
+def tableGroups(groupTable):
+    return set(g for groups in groupTable.values() for g in groups)
+
+
+def parseContrasts(contrasts, groupTable):
+    """'fg' or 'fg:bg' strings -> [Contrast], checking the groups exist"""
+    known = tableGroups(groupTable)
+    parsed = []
+    for contrast in contrasts:
+        foreground, _, background = contrast.partition(':')
+        for group in (foreground, background):
+            if group and group not in known:
+                raise ValueError(f"Unknown group '{group}' in contrast '{contrast}' -- the group table has {sorted(known)}")
+            continue
+        parsed.append(Contrast(contrast, foreground, background or None))
+        continue
+    return parsed
+
+
+def sampleKey(name, keys):
+    """Longest table key found in name as a whole underscore delimited part"""
+    padded = f"_{name.lower()}_"
+    matches = [k for k in keys if f"_{k}_" in padded]
+    return max(matches, key=len) if matches else None
+
+
+def compileGroupMasks(names, groupTable):
+    """{group: boolean row mask} for the samples of one alignment"""
+    keys = list(groupTable)
+    masks = {}
+    for row, name in enumerate(names):
+        key = sampleKey(name, keys)
+        if key is None:
+            continue
+        for group in groupTable[key]:
+            masks.setdefault(group, np.zeros(len(names), dtype=bool))[row] = True
+            continue
+        continue
+    return masks
+
+
+def compileContrasts(names, groupTable, contrasts):
+    """Resolve contrasts to foreground/background row masks for one alignment.
+    Contrasts with an empty foreground or background are dropped."""
+    groupMasks = compileGroupMasks(names, groupTable)
+    empty = np.zeros(len(names), dtype=bool)
+    compiled = []
+    for contrast in contrasts:
+        foreground = groupMasks.get(contrast.foreground, empty)
+        if contrast.background is None:
+            background = ~foreground
+        else:
+            background = groupMasks.get(contrast.background, empty) & ~foreground
+        if foreground.any() and background.any():
+            compiled.append(CompiledContrast(contrast.label, foreground, background))
+        continue
+    return compiled
+
+
+########################## Contrast Scan ##########################
+# Residue counts held at once (symbols x 2*contrasts x columns, int32 --
+# about 64 MB). Windows are scanned in column blocks that fit, so memory
+# stays bounded however many contrasts are asked for.
+COUNT_CELLS = 1 << 24
+
+
+def findCladeSubstitutions(matrix, contrasts, columnOffset=0, maxGapFraction=0.5, maxStates=2):
+    """Return CONTRAST_COLUMNS rows for every (column, contrast) hit in a
+    (samples x columns) uint8 matrix window. contrasts come from compileContrasts()."""
+    if not contrasts or matrix.shape[1] == 0:
+        return []
+    # (2 * contrasts) x samples -- foreground and background masks interleaved
+    masks = np.array([m for c in contrasts for m in (c.foregroundMask, c.backgroundMask)], dtype=np.float32)
+    symbols = np.unique(matrix)
+    blockColumns = max(1, COUNT_CELLS // (len(symbols) * len(masks)))
+    hits = []
+    for start in range(0, matrix.shape[1], blockColumns):
+        block = matrix[:, start:start+blockColumns]
+        hits.extend(blockSubstitutions(block, masks, symbols, contrasts, columnOffset + start, maxGapFraction, maxStates))
+        continue
+    # Position order, contrasts in the order they were asked for
+    hits.sort(key=lambda hit: hit[1])
+    return hits
+
+
+def blockSubstitutions(matrix, masks, symbols, contrasts, columnOffset, maxGapFraction, maxStates):
+    """Contrast hits of one column block, in contrast order"""
+    # symbols x masks x columns residue counts, one matrix product per symbol
+    counts = np.empty((len(symbols), len(masks), matrix.shape[1]), dtype=np.int32)
+    for n, symbol in enumerate(symbols):
+        counts[n] = masks @ (matrix == symbol).astype(np.float32)
+        continue
+    isGap = symbols == GAP
+    columns = np.arange(matrix.shape[1])
+    hits = []
+    for n, contrast in enumerate(contrasts):
+        foreground, background = counts[:, 2*n, :], counts[:, 2*n+1, :]
+        total = foreground + background
+        rows = contrast.foregroundMask.sum() + contrast.backgroundMask.sum()
+        gapFraction = total[isGap].sum(axis=0) / rows
+        states = (total > 0).sum(axis=0)
+        foreground = np.where(isGap[:, None], 0, foreground)
+        background = np.where(isGap[:, None], 0, background)
+        derived = foreground.argmax(axis=0)
+        isHit = (
+            (gapFraction <= maxGapFraction)
+            & (states <= maxStates)
+            & ((foreground > 0).sum(axis=0) == 1)
+            & (background[derived, columns] == 0)
+            & (background.sum(axis=0) > 0)
+        )
+        for col in np.flatnonzero(isHit):
+            hits.append([
+                contrast.label,
+                int(col) + columnOffset,
+                chr(symbols[derived[col]]),
+                ''.join(chr(s) for s in symbols[background[:, col] > 0]),
+                int(foreground[:, col].sum()),
+                int(background[:, col].sum()),
+                matrix[:, col].tobytes().decode(),
+            ])
+            continue
+        continue
+    return hits
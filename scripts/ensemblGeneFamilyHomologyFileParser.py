@@ -5,12 +5,29 @@ Version: 0.0.1
 Date: 4/17/2021
 """
 import argparse
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import mmap
+import os
+import re
+import sqlite3
+import sys
 from pathlib import Path
 
 import pandas as pd
 from ete3 import Tree
 from ete3.coretype.tree import TreeError
 
+from stageMetrics import NULL_METRICS, addMetricsArguments, makeMetrics, startProfile, stopProfile
+
+# Optional dependency -- only needed for --columnar output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 ########################## Helper Functions ##########################
 def writeTreeFile(data, filename):
     with open(filename, 'w') as oh:
@@ -26,84 +43,596 @@ def writeNullOutput(nullResult, df):
 
 
 def getFileChunks(INPUT, fileChunkOutput):
-    """This function will return a dictionary with keys chunk_1 through chunk-n,
-    key value is a list of lines from the file """
-    currentChunk = 1
-    with open(INPUT) as fh:
-        geneFamily = fh.read().split("//\n")
-        for count, group in enumerate(geneFamily, 1):
-            if count % 10 == 0:
-                print(f"-- {count:,}/{len(geneFamily):,} --")
-            seqlines = [l for l in group.split("\n") if l != '']
-            currChunkDir = fileChunkOutput / f"chunk_{currentChunk}"
-            currChunkDir.mkdir(parents=True, exist_ok=True)  # Make output directory
-            currChunkSeqFile = currChunkDir / f"chunk_{currentChunk}_SEQ.tsv"
-            currChunkTreeFile = currChunkDir / f"chunk_{currentChunk}_Newick.tree"
-            for i, l in enumerate(reversed(seqlines), 1):
-                if not l: # Skips blank lines
-                    continue
-                elif ';' in l:  # Write out newick file
-                    writeTreeFile(l, currChunkTreeFile)
-                    continue
-                elif "SEQ" in l:
-                    seqdata = [l.split(" ") for l in seqlines[:len(seqlines)-i]]
-                    avglen = sum([len(i) for i in seqdata]) / len(seqdata)
-                    print(avglen, max([len(i) for i in seqdata]), min([len(i) for i in seqdata]))
-
-                    for l in seqdata:
-                        if len(l) > 9:
-                            print(l)
-
-                    try:
-                        df = pd.DataFrame(data=seqdata, columns=range(len(seqdata[0])))
-                    except ValueError:
-                        print(seqdata)
-                        raise ValueError
-                    # df.to_csv(currChunkSeqFile, sep="\t", index=False)
-                    break
-                # else:
-                #     break
-            currentChunk += 1
-            continue
+    """This function will write each family of the emf file to
+    its own chunk_1 through chunk-n directory (SEQ table + Newick tree)"""
+    for currentChunk, family in enumerate(readFamilies(INPUT), 1):
+        if currentChunk % 10 == 0:
+            print(f"-- {currentChunk:,} --")
+        currChunkDir = fileChunkOutput / f"chunk_{currentChunk}"
+        currChunkDir.mkdir(parents=True, exist_ok=True)  # Make output directory
+        currChunkSeqFile = currChunkDir / f"chunk_{currentChunk}_SEQ.tsv"
+        currChunkTreeFile = currChunkDir / f"chunk_{currentChunk}_Newick.tree"
+        if family.tree:
+            writeTreeFile(family.tree, currChunkTreeFile)
+        df = pd.DataFrame(data=family.seqdata)
+        df.to_csv(currChunkSeqFile, sep="\t", index=False, header=False)
+        continue
     return
 
 
-def make_scientific_name_tree(tree, df):
-    tree_str = str(tree)
-    for pid, sn in zip(df['ProteinID'].to_list(), df['Species'].to_list()):
-        tree_str = tree_str.replace(pid, sn)
+def drop_non_species_of_interest(df, speciesTable):
+    return df[df['Species'].isin(speciesTable.scientificNames)]
+
+
+def addCopyNumbers(df):
+    """Add SpeciesCopyNumber and OrderCopyNumber columns -- the number
+    of family members from the same species/order as each row"""
+    df['SpeciesCopyNumber'] = df.groupby('Species', dropna=False, sort=False)['Species'].transform('size')
+    df['OrderCopyNumber'] = df.groupby('Order', dropna=False, sort=False)['Species'].transform('size')
+    return df
+
+
+########################## Species Table ##########################
+"""
+The species file is compiled once per run into a hashed set of
+scientific names plus scientific name -> common name/order lookups,
+which every family is then filtered and annotated against.
+"""
+SpeciesTable = namedtuple('SpeciesTable', ['speciesDF', 'scientificNames', 'commonNames', 'orders'])
+
+
+def loadSpeciesTable(SPECIES):
+    """Read + compile the species file (empty table when SPECIES is None)"""
+    # I have it written to take an excel file
+    # or a csv file ¯\_(ツ)_/¯ 
+    try:
+        species_path = Path(SPECIES)
+        if 'csv' in species_path.name:
+            speciesDF = pd.read_csv(species_path, sep='\t')
+        elif 'xls' in species_path.name:
+            speciesDF = pd.read_excel(species_path, engine='openpyxl')
+    except TypeError:
+        speciesDF = pd.DataFrame()
+    return compileSpeciesTable(speciesDF)
+
+
+def compileSpeciesTable(speciesDF):
+    if speciesDF.empty:
+        return SpeciesTable(speciesDF, frozenset(), {}, {})
+    scientificNames = frozenset(speciesDF['scientific_name'])
+    commonNames = dict(zip(speciesDF['scientific_name'], speciesDF['common_name']))
+    orders = dict(zip(speciesDF['scientific_name'], speciesDF['order']))
+    return SpeciesTable(speciesDF, scientificNames, commonNames, orders)
+
+
+######################### Tree Relabel Functions #########################
+"""
+Leaf labels are swapped in a single pass over the tokenized Newick
+string. Only leaf name tokens are replaced (exact matches from the label
+dictionaries), so IDs that are prefixes of one another, branch lengths
+and internal support values are never touched.
+"""
+NEWICK_TOKENS = re.compile(r'[(),:;]|[^(),:;]+')
+
+
+def tokenizeNewick(newick):
+    """Split a Newick string into tokens and return them along
+    with the token positions that hold leaf names"""
+    tokens = NEWICK_TOKENS.findall(newick)
+    leaves = [n for n, t in enumerate(tokens) if (t[0] not in '(),:;') and ((n == 0) or (tokens[n-1] in '(,'))]
+    return tokens, leaves
+
+
+def relabelNewick(newick, labelMaps):
+    """Return a {variant: newick} dictionary with the leaves of newick
+    relabelled by each {variant: {old label: new label}} map. Leaves
+    without an entry keep their current label."""
+    tokens, leaves = tokenizeNewick(newick)
+    relabelled = {}
+    for variant, labels in labelMaps.items():
+        variantTokens = list(tokens)
+        for n in leaves:
+            variantTokens[n] = str(labels.get(tokens[n], tokens[n]))
+            continue
+        relabelled[variant] = ''.join(variantTokens)
         continue
-    return tree_str
+    return relabelled
+
+
+def makeLabelledTrees(newick, df):
+    """Relabel a ProteinID leaf tree with the scientific, common and
+    gene names of the family DataFrame"""
+    commonNames = [cn if isinstance(cn, str) and cn else sn for sn, cn in zip(df['Species'], df['CommonName'])]
+    labelMaps = {
+        'ProteinID': {},
+        'ScientificName': dict(zip(df['ProteinID'], df['Species'])),
+        'CommonName': dict(zip(df['ProteinID'], commonNames)),
+        'GeneName': dict(zip(df['ProteinID'], df['Gene'])),
+    }
+    return relabelNewick(newick, labelMaps)
+
+
+########################## EMF Reader Functions ##########################
+"""
+Input file structure: (Compara.102.protein_default.nh)
+    - 'SEQ' data
+    - 'DATA' header
+    - Newick phylogenetic tree
+    - '//' to indicate break to next set of data
+    - Blank line
+    - Next set of 'SEQ' data...
+"""
+GeneFamily = namedtuple('GeneFamily', ['seqdata', 'header', 'tree'])
+
 
+def isGzipFile(INPUT):
+    """gzip and bgzip files both start with the gzip magic bytes"""
+    with open(INPUT, 'rb') as fh:
+        return fh.read(2) == b'\x1f\x8b'
 
-def make_gene_name_tree(tree, df):
-    tree_str = str(tree)
-    for pid, gene in zip(df['ProteinID'].to_list(), df['Gene'].to_list()):
-        tree_str = tree_str.replace(pid, gene)
+
+def openEmfFile(INPUT):
+    """Open a plain, gzip or bgzip emf file for reading text"""
+    if isGzipFile(INPUT):
+        return gzip.open(INPUT, 'rt')
+    return open(INPUT)
+
+
+def parseSeqLine(line):
+    """Split a SEQ row into its columns. Genes can have spaces in
+    their names at the end of the row, so the name is joined back
+    together with underscores."""
+    l = line.split(" ")
+    if len(l) > 9:
+        l[8:len(l)+1] = ['_'.join(l[8:len(l)+1])]
+    return l
+
+
+def splitSeqLines(seqLines, metrics=NULL_METRICS):
+    with metrics.stage('split'):
+        return [parseSeqLine(line) for line in seqLines]
+
+
+def iterFamilies(lines, metrics=NULL_METRICS):
+    """Group an iterable of emf lines into GeneFamily tuples, one
+    family at a time. Families without any SEQ rows are skipped."""
+    seqLines, header, tree = [], None, None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line: # Skips blank lines
+            continue
+        elif line == '//':
+            if seqLines:
+                yield GeneFamily(splitSeqLines(seqLines, metrics), header, tree)
+            seqLines, header, tree = [], None, None
+        elif line.startswith('SEQ'):
+            seqLines.append(line)
+        elif line.startswith('DATA'):
+            header = line
+        elif ';' in line:
+            tree = line
         continue
-    return tree_str
+    # Trailing family without a closing '//'
+    if seqLines:
+        yield GeneFamily(splitSeqLines(seqLines, metrics), header, tree)
+    return
+
+
+def readFamilies(INPUT, metrics=NULL_METRICS):
+    """Stream the families of an emf file. Only a single family
+    is held in memory at a time."""
+    with openEmfFile(INPUT) as fh:
+        yield from iterFamilies(fh, metrics)
+    return
+
+
+def buildFamilyDataFrame(seqdata, speciesTable):
+    """Build the per-family DataFrame from parsed SEQ rows and
+    attach common name + order information from the species table"""
+    df = pd.DataFrame(data=seqdata, columns=['SEQ', 'Species', 'ProteinID', 'Chromosome', 'Start', 'Stop', 'gain-loss?', 'GeneID', 'Gene'])
+    df = df.drop(labels=['SEQ', 'gain-loss?', 'Start', 'Stop', 'Chromosome'], axis=1)
+    df['CommonName'] = df['Species'].map(speciesTable.commonNames)
+    df['Order'] = df['Species'].map(speciesTable.orders)
+    # Replace None with "NULL", None throws error
+    df['Gene'] = [g if isinstance(g, str) and g else 'NULL' for g in df['Gene']]
+    return df
+
+
+FamilyResult = namedtuple('FamilyResult', ['status', 'df', 'trees', 'tree'])
+
+
+def summarizeFamily(df, tree, geneOfInterest, currentChunk, speciesTable, metrics=NULL_METRICS):
+    """Filter, prune and relabel a single gene family that contains
+    geneOfInterest without writing anything. Returns a FamilyResult with
+    status 'ok' (df holds the species counts, trees the labelled Newick
+    trees), 'null' (only NULL gene names left) or 'malformed' (the tree
+    could not be pruned). Time spent is recorded per stage (filter,
+    prune, relabel, count)."""
+    df = df.copy()
+    df['Chunk'] = [f'{geneOfInterest}_chunk_{currentChunk}']*len(df)
+    # Filter out non-species of interest entries
+    if speciesTable.speciesDF.empty:
+        with metrics.stage('prune'):
+            tree = Tree(tree)
+            tree.prune(df['ProteinID'].to_list(), preserve_branch_length=True)
+        # Convert tree leaves to scientific and gene names
+        with metrics.stage('relabel'):
+            labelledTrees = makeLabelledTrees(tree.write(), df)
+
+        # Organize data into columns [geneID, Speceies, Order, SpeciesCopyNum, OrderCopyNum]
+        with metrics.stage('count'):
+            df = addCopyNumbers(df)
+            df = df[['Gene', 'Species', 'CommonName', 'Order', 'SpeciesCopyNumber', 'OrderCopyNumber', 'Chunk', 'GeneID', 'ProteinID']]  # Reorder columns
+        return FamilyResult('ok', df, labelledTrees, tree)
+    with metrics.stage('filter'):
+        # Remove species that are not in species of interest file
+        df = drop_non_species_of_interest(df, speciesTable)
+        # Sort by Order
+        df = df.sort_values(by='Order')
+        allNull = (len(df['Gene'].unique()) == 1) and (df['Gene'].unique()[0] == 'NULL')
+    # If all species have NULL as gene, output null result file
+    if allNull:
+        metrics.add('null_results')
+        return FamilyResult('null', df, None, tree)
+    # This checks to make sure the newick tree is valid,
+    # if not then it will return a file saying the tree
+    # is malformed
+    try:
+        with metrics.stage('prune'):
+            tree = Tree(tree)
+            tree.prune(df['ProteinID'].to_list(), preserve_branch_length=True)
+    except TreeError:
+        metrics.add('malformed_trees')
+        return FamilyResult('malformed', df, None, tree)
 
+    # Convert tree leaves to scientific, common, and gene names
+    with metrics.stage('relabel'):
+        labelledTrees = makeLabelledTrees(tree.write(), df)
 
-def make_common_name_tree(tree, sdf):
-    tree_str = str(tree)
-    for sn, cn, in zip(sdf['scientific_name'], sdf['common_name']):
-        tree_str = tree_str.replace(sn, cn)
+    # Organize data into columns [geneID, Speceies, Order, SpeciesCopyNum, OrderCopyNum]
+    with metrics.stage('count'):
+        df = addCopyNumbers(df)
+
+        # Reorder columns
+        df = df[['Gene', 'Species', 'CommonName', 'Order', 'SpeciesCopyNumber', 'OrderCopyNumber', 'Chunk', 'GeneID', 'ProteinID']]
+    return FamilyResult('ok', df, labelledTrees, tree)
+
+
+def processFamily(df, tree, geneOfInterest, currentChunk, OUTPUT, speciesTable, metrics=NULL_METRICS):
+    """Write the chunk output files for a single gene family that
+    contains geneOfInterest to chunk number currentChunk. Returns the
+    species count DataFrame, or None if the family had no usable data.
+    Time spent is recorded per stage (filter, prune, relabel, count, write)."""
+    result = summarizeFamily(df, tree, geneOfInterest, currentChunk, speciesTable, metrics)
+    return writeFamilyResult(result, geneOfInterest, currentChunk, OUTPUT, speciesTable, metrics)
+
+
+def writeFamilyResult(result, geneOfInterest, currentChunk, OUTPUT, speciesTable, metrics=NULL_METRICS):
+    """Write the chunk output files of a summarizeFamily() result"""
+    # Output File Names
+    fileChunkOutput = OUTPUT / f'{geneOfInterest}'
+    speciesCountOutput = OUTPUT / 'speciesCounts'
+    speciesCountOutput.mkdir(parents=True, exist_ok=True)  # Create output directory
+    currChunkDir = fileChunkOutput / f"chunk_{currentChunk}"
+    currChunkDir.mkdir(parents=True, exist_ok=True)  # Create output directory
+    currChunkSeqFile = currChunkDir / f"chunk_{currentChunk}_SEQ.tsv"
+    currChunkPidTreeFile = currChunkDir / f"chunk_{currentChunk}_ProteinID_Newick.tree"
+    currChunkSciNameTreeFile = currChunkDir / f"chunk_{currentChunk}_ScientificName_Newick.tree"
+    currChunkCommonNameTreeFile = currChunkDir / f"chunk_{currentChunk}_CommonName_Newick.tree"
+    currChunkGeneTreeFile = currChunkDir / f"chunk_{currentChunk}_GeneName_Newick.tree"
+    CountSummaryOutputFileName = speciesCountOutput / f'{geneOfInterest}_copy_number_summary_chunk_{currentChunk}.txt'
+    nullResult = currChunkDir / 'null_result.txt'
+    malformedTree = currChunkDir / 'malformed_tree.txt'
+    if result.status == 'null':
+        writeNullOutput(nullResult, result.df)
+        return None
+    if result.status == 'malformed':
+        writeTreeFile(result.tree, malformedTree)
+        return None
+
+    # Output all files
+    df, labelledTrees = result.df, result.trees
+    with metrics.stage('write'):
+        writeTreeFile(labelledTrees['ProteinID'], currChunkPidTreeFile)
+        writeTreeFile(labelledTrees['ScientificName'], currChunkSciNameTreeFile)
+        if not speciesTable.speciesDF.empty:
+            writeTreeFile(labelledTrees['CommonName'], currChunkCommonNameTreeFile)
+        writeTreeFile(labelledTrees['GeneName'], currChunkGeneTreeFile)
+        df.to_csv(CountSummaryOutputFileName, sep='\t', index=False)
+
+        # Output null file if no data present
+        if df.empty and not speciesTable.speciesDF.empty:
+            with open(nullResult, 'w') as oh:
+                oh.write('No data available')
+        else:
+            df.to_csv(currChunkSeqFile, sep="\t", index=False)
+    return df
+
+
+def familyGenes(seqdata):
+    """Lowercase gene names found in a family's SEQ rows"""
+    return {(l[8] if len(l) > 8 and l[8] else 'NULL').lower() for l in seqdata}
+
+
+########################## Worker Functions ##########################
+# Matched families are handed to processFamilyHits(), either directly
+# or through a process pool. The run-wide output directory and species
+# table are set once per worker process by initFamilyWorker().
+_workerState = {}
+
+
+def initFamilyWorker(OUTPUT, speciesTable, collectMetrics=False):
+    _workerState['OUTPUT'] = OUTPUT
+    _workerState['speciesTable'] = speciesTable
+    _workerState['metrics'] = makeMetrics(collectMetrics)
+    return
+
+
+def processFamilyHits(seqdata, tree, hits):
+    """Build the family DataFrame once and write the outputs
+    for every (geneOfInterest, chunk number) pair in hits. Returns
+    the species count DataFrames of the hits + a snapshot of the
+    stage metrics collected for them (None without --metrics)."""
+    OUTPUT = _workerState['OUTPUT']
+    speciesTable = _workerState['speciesTable']
+    metrics = _workerState['metrics']
+    try:
+        with metrics.stage('dataframe'):
+            df = buildFamilyDataFrame(seqdata, speciesTable)
+    except ValueError:
+        return [], metrics.snapshot()
+    countDFs = []
+    for geneOfInterest, currentChunk in hits:
+        countDF = processFamily(df, tree, geneOfInterest, currentChunk, OUTPUT, speciesTable, metrics)
+        if countDF is not None:
+            countDFs.append(countDF)
         continue
-    return tree_str
+    return countDFs, metrics.snapshot()
+
+##################### Cumulative Count Writer #####################
+COUNT_COLUMNS = ['Gene', 'Species', 'CommonName', 'Order', 'SpeciesCopyNumber', 'OrderCopyNumber', 'Chunk', 'GeneID', 'ProteinID']
+DICTIONARY_COLUMNS = ['Gene', 'Species', 'CommonName', 'Order', 'Chunk']
 
 
-def drop_non_species_of_interest(df, speciesDF):
-    indexToDrop = []
-    for n, species in zip(df.index, df['Species']):
-        if species not in speciesDF['scientific_name'].to_list():
-            indexToDrop.append(n)
+class CumulativeCountWriter:
+    """Appends the species counts of each finished family to
+    CumulativeSpeciesCounts.tsv as the run goes, and optionally to a
+    Parquet or Arrow IPC file with dictionary encoded Gene, Species,
+    CommonName, Order and Chunk columns.
+
+    The columnar dictionaries only ever grow, so every batch written
+    after the first is a dictionary delta of the one before it."""
+    def __init__(self, tsvPath, columnarPath=None, columnarFormat=None, batchRows=50000):
+        self.tsv = open(tsvPath, 'w')
+        self.tsv.write('\t'.join(COUNT_COLUMNS) + '\n')
+        self.columnarPath = columnarPath
+        self.columnarFormat = columnarFormat
+        self.batchRows = batchRows
+        self.buffer = []
+        self.bufferedRows = 0
+        self.writer = None
+        if columnarFormat is None:
+            return
+        if pa is None:
+            raise ImportError("pyarrow is required for --columnar output (pip install pyarrow)")
+        fields = []
+        for c in COUNT_COLUMNS:
+            if c in DICTIONARY_COLUMNS:
+                fields.append((c, pa.dictionary(pa.int32(), pa.string())))
+            elif c.endswith('CopyNumber'):
+                fields.append((c, pa.int32()))
+            else:
+                fields.append((c, pa.string()))
+            continue
+        self.schema = pa.schema(fields)
+        self.dictionaries = {c:{} for c in DICTIONARY_COLUMNS}
+        if columnarFormat == 'parquet':
+            self.writer = pq.ParquetWriter(columnarPath, self.schema)
         else:
+            options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            self.writer = pa.ipc.new_file(columnarPath, self.schema, options=options)
+        return
+
+    def write(self, df):
+        df = df[COUNT_COLUMNS]
+        df.to_csv(self.tsv, sep='\t', index=False, header=False)
+        if self.writer is None:
+            return
+        self.buffer.append(df)
+        self.bufferedRows += len(df)
+        if self.bufferedRows >= self.batchRows:
+            self.flush()
+        return
+
+    def encodeDictionaryColumn(self, column, values):
+        codes = self.dictionaries[column]
+        indices = [None if pd.isna(v) else codes.setdefault(str(v), len(codes)) for v in values]
+        return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), pa.array(list(codes), type=pa.string()))
+
+    def flush(self):
+        if not self.buffer:
+            return
+        df = pd.concat(self.buffer, ignore_index=True)
+        self.buffer = []
+        self.bufferedRows = 0
+        arrays = []
+        for field in self.schema:
+            if field.name in self.dictionaries:
+                arrays.append(self.encodeDictionaryColumn(field.name, df[field.name]))
+            elif pa.types.is_integer(field.type):
+                arrays.append(pa.array(df[field.name].astype('int64'), type=field.type))
+            else:
+                arrays.append(pa.array([None if pd.isna(v) else str(v) for v in df[field.name]], type=field.type))
             continue
-    df = df.drop(index=indexToDrop)
-    return df
+        batch = pa.record_batch(arrays, schema=self.schema)
+        if self.columnarFormat == 'parquet':
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        return
+
+    def close(self):
+        self.tsv.close()
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+######################### Family Index Functions #########################
+"""
+The family index is a small SQLite database that records the byte offset
+and length of every '//' delimited family in an emf file, along with an
+inverted table from Gene, GeneID and ProteinID to the families they are
+found in. Lookups read the matching families straight out of a memory
+mapped copy of the emf file instead of re-scanning it.
+"""
+INDEX_BATCH_SIZE = 50000
+
+
+def defaultIndexPath(INPUT):
+    return Path(f"{INPUT}.idx.sqlite")
+
+
+def emfFileStats(INPUT):
+    stats = os.stat(INPUT)
+    return {'source': Path(INPUT).resolve().as_posix(), 'size': str(stats.st_size), 'mtime_ns': str(stats.st_mtime_ns)}
+
+
+def parseSeqLineKeys(line):
+    """Return the (name, field) pairs indexed for a single SEQ row"""
+    l = parseSeqLine(line)
+    keys = []
+    for field, n in (('ProteinID', 2), ('GeneID', 7), ('Gene', 8)):
+        if len(l) > n and l[n]:
+            keys.append((l[n].lower(), field))
+    return keys
+
+
+def buildFamilyIndex(INPUT, indexPath):
+    """Scan the emf file once and write the family index to indexPath"""
+    if isGzipFile(INPUT):
+        raise ValueError(f"{INPUT} is compressed -- the family index needs an uncompressed emf file to memory map")
+    tmpIndexPath = Path(f"{indexPath}.tmp")
+    if tmpIndexPath.exists():
+        tmpIndexPath.unlink()
+    conn = sqlite3.connect(tmpIndexPath)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE families (family_id INTEGER PRIMARY KEY, offset INTEGER, length INTEGER)')
+    conn.execute('CREATE TABLE members (name TEXT, field TEXT, family_id INTEGER)')
+    families = []
+    members = []
+    familyID = 0
+    familyStart = 0
+    offset = 0
+    with open(INPUT, 'rb') as fh:
+        for line in fh:
+            offset += len(line)
+            if line.startswith(b'SEQ'):
+                for name, field in parseSeqLineKeys(line.decode().rstrip('\r\n')):
+                    members.append((name, field, familyID))
+            elif line.rstrip(b'\r\n') == b'//':
+                families.append((familyID, familyStart, offset - familyStart))
+                familyID += 1
+                familyStart = offset
+            if len(members) >= INDEX_BATCH_SIZE:
+                conn.executemany('INSERT INTO members VALUES (?, ?, ?)', members)
+                conn.executemany('INSERT INTO families VALUES (?, ?, ?)', families)
+                members, families = [], []
+            continue
+    # Trailing family without a closing '//'
+    if offset > familyStart:
+        families.append((familyID, familyStart, offset - familyStart))
+    conn.executemany('INSERT INTO members VALUES (?, ?, ?)', members)
+    conn.executemany('INSERT INTO families VALUES (?, ?, ?)', families)
+    conn.execute('CREATE INDEX members_name ON members (name, field)')
+    conn.executemany('INSERT INTO meta VALUES (?, ?)', emfFileStats(INPUT).items())
+    conn.commit()
+    conn.close()
+    os.replace(tmpIndexPath, indexPath)
+    return
+
+
+def openFamilyIndex(INPUT, indexPath):
+    """Open an existing family index, making sure it was built
+    from the current version of INPUT"""
+    if not Path(indexPath).exists():
+        raise FileNotFoundError(f"Family index {indexPath} does not exist -- build it with the 'index' subcommand")
+    conn = sqlite3.connect(indexPath)
+    meta = dict(conn.execute('SELECT key, value FROM meta'))
+    current = emfFileStats(INPUT)
+    if (meta.get('size'), meta.get('mtime_ns')) != (current['size'], current['mtime_ns']):
+        conn.close()
+        raise ValueError(f"Family index {indexPath} is out of date for {INPUT} -- rebuild it with the 'index' subcommand")
+    return conn
+
+
+def lookupFamilies(conn, names, field='Gene'):
+    """Return (family_id, offset, length) for every family containing
+    one of names in field, in file order. Names are matched case
+    insensitively."""
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS query (name TEXT PRIMARY KEY)')
+    conn.execute('DELETE FROM query')
+    conn.executemany('INSERT OR IGNORE INTO query VALUES (?)', [(str(n).lower(),) for n in names])
+    families = conn.execute(
+        'SELECT DISTINCT f.family_id, f.offset, f.length FROM query q '
+        'JOIN members m ON m.name = q.name AND m.field = ? '
+        'JOIN families f ON f.family_id = m.family_id '
+        'ORDER BY f.family_id',
+        (field,),
+    ).fetchall()
+    return families
+
+
+def readIndexedFamilies(INPUT, families, metrics=NULL_METRICS):
+    """Yield each indexed family from a memory map of INPUT"""
+    with open(INPUT, 'rb') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for _, offset, length in families:
+                yield from iterFamilies(mm[offset:offset+length].decode().split("\n"), metrics)
+    return
+
+
+def buildIndexMain(argv):
+    parser = argparse.ArgumentParser(description='Build a family index for an Ensembl emf file')
+    parser.add_argument(
+        '-i',
+        '--input',
+        type=str,
+        action='store',
+        required=True,
+        help="Ensembl emf file to index (uncompressed)",
+    )
+    parser.add_argument(
+        '--index',
+        type=str,
+        action='store',
+        default=None,
+        help='Output index file [default: <input>.idx.sqlite]',
+    )
+    args = parser.parse_args(argv)
+    INPUT = Path(args.input)
+    INDEX = Path(args.index) if args.index else defaultIndexPath(INPUT)
+    print(f'--- Building family index for {INPUT} ---')
+    buildFamilyIndex(INPUT, INDEX)
+    print(f'--- Family index written to {INDEX} ---')
+    return
 
 ########################### Main Function ###########################
 def main():
+    # 'index' subcommand builds the family index used by --index
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        buildIndexMain(sys.argv[2:])
+        return
     # These are the flags the user will use to tie input
     # values like file paths and parameter values.
     parser = argparse.ArgumentParser(description='')
@@ -139,7 +668,32 @@ def main():
         default=None,
         help='Species of interest list (single species name per line -- basic txt file)',
     )
+    parser.add_argument(
+        '--index',
+        type=str,
+        action='store',
+        default=None,
+        help="Family index built with the 'index' subcommand -- only matching families are read",
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        action='store',
+        default=1,
+        help='Number of processes used to build the output files of matched families',
+    )
+    parser.add_argument(
+        '--columnar',
+        type=str,
+        action='store',
+        choices=['parquet', 'arrow'],
+        default=None,
+        help='Also write the cumulative species counts as Parquet or Arrow IPC (requires pyarrow)',
+    )
+    addMetricsArguments(parser)
     args = parser.parse_args()
+    profiler = startProfile(args.profile)
+    metrics = makeMetrics(args.metrics)
     
     # --- Input Argparse Variables ---
     # We need a way to tie the inputs provided
@@ -150,181 +704,83 @@ def main():
     OUTPUT.mkdir(parents=True, exist_ok=True)
     SPECIES = args.species
     INPUT_GENES = args.INPUT_GENE
+    INDEX = args.index
+    WORKERS = max(1, args.workers)
+    COLUMNAR = args.columnar
 
-    # Load in species file
-    # I have it written to take an excel file
-    # or a csv file ¯\_(ツ)_/¯ 
-    try:
-        species_path = Path(SPECIES)
-        if 'csv' in species_path.name:
-            speciesDF = pd.read_csv(species_path, sep='\t')
-        elif 'xls' in species_path.name:
-            speciesDF = pd.read_excel(species_path, engine='openpyxl')
-    except TypeError:
-        speciesDF = pd.DataFrame()
+    speciesTable = loadSpeciesTable(SPECIES)
 
     # Load in gene name file and set into list
     genesToLookUp = [g.strip() for g in open(INPUT_GENES).readlines()]
 
-    """
-    Input file structure: (Compara.102.protein_default.nh)
-        - 'SEQ' data
-        - 'DATA' header
-        - Newick phyloINPUT_GENEtic tree
-        - '//' to indicate break to next set of data
-        - Blank line
-        - Next set of 'SEQ' data...
-    """
-    for geneOfInterest in genesToLookUp:
-        print(f'--- Collecting results for {geneOfInterest} ---')
-        # Step 1: Parse file into chunks
-        fileChunkOutput = OUTPUT / f'{geneOfInterest}'
-        currentChunk = 1
-        with open(INPUT) as fh:
-            geneFamily = fh.read().split("//\n")
-            for group in geneFamily:
-                seqlines = [l for l in group.split("\n") if l != '']
-                for i, l in enumerate(reversed(seqlines), 1):
-                    if not l: # Skips blank lines if not caught
-                        continue
-                    elif ';' in l:
-                        tree = l
-                        continue
-                    elif "SEQ" in l:
-                        seqdata = [l.split(" ") for l in seqlines[:len(seqlines)-i]]
-                        # This section fixes an issue where INPUT_GENEs have
-                        # spaces in their names at the end of the row
-                        # This joins the name by replacing the space
-                        # with an underscore 
-                        for l in seqdata:
-                            if len(l) > 9:
-                                l[8:len(l)+1] = ['_'.join(l[8:len(l)+1])] 
-                        try:
-                            df = pd.DataFrame(data=seqdata, columns=['SEQ', 'Species', 'ProteinID', 'Chromosome', 'Start', 'Stop', 'gain-loss?', 'GeneID', 'Gene'])
-                            df = df.drop(labels=['SEQ', 'gain-loss?', 'Start', 'Stop', 'Chromosome'], axis=1)
-                            CommonNameConvertDict = {sn:cn for sn,cn in zip(speciesDF['scientific_name'], speciesDF['common_name'])}
-                            CommonNameConvertDict['None'] = None
-                            df['CommonName'] = [CommonNameConvertDict.get(str(g)) for g in df['Species']]
-                            OrderConvertDict = {sn:order for sn,order in zip(speciesDF['scientific_name'], speciesDF['order'])}
-                            df['Order'] = [OrderConvertDict.get(str(g)) for g in df['Species']]
-                            df['Chunk'] = [f'{geneOfInterest}_chunk_{currentChunk}']*len(df)
-                        except:
-                            # print(seqdata)
-                            pass
-                        df['Gene'] = df['Gene'].apply(lambda x: 'NULL' if not x else x) # Replace None with "NULL", None throws error
-                        for gene in df['Gene']:
-                            if str(geneOfInterest).lower() == str(gene).lower():
-                                print(f"Data found for {geneOfInterest}")
-                                # Output File Names
-                                speciesCountOutput = OUTPUT / 'speciesCounts'
-                                speciesCountOutput.mkdir(parents=True, exist_ok=True)  # Create output directory
-                                currChunkDir = fileChunkOutput / f"chunk_{currentChunk}"
-                                currChunkDir.mkdir(parents=True, exist_ok=True)  # Create output directory
-                                currChunkSeqFile = currChunkDir / f"chunk_{currentChunk}_SEQ.tsv"
-                                currChunkPidTreeFile = currChunkDir / f"chunk_{currentChunk}_ProteinID_Newick.tree"
-                                currChunkSciNameTreeFile = currChunkDir / f"chunk_{currentChunk}_ScientificName_Newick.tree"
-                                currChunkCommonNameTreeFile = currChunkDir / f"chunk_{currentChunk}_CommonName_Newick.tree"
-                                currChunkGeneTreeFile = currChunkDir / f"chunk_{currentChunk}_GeneName_Newick.tree"
-                                CountSummaryOutputFileName = speciesCountOutput / f'{geneOfInterest}_copy_number_summary_chunk_{currentChunk}.txt'
-                                orderGeneCount = speciesCountOutput / f'{geneOfInterest}_OrderCounts_chunk_{currentChunk}.txt'
-                                nullResult = currChunkDir / 'null_result.txt'
-                                malformedTree = currChunkDir / 'malformed_tree.txt'
-                                # Filter out non-species of interest entries
-                                if speciesDF.empty:
-                                    df.to_csv(currChunkSeqFile, sep="\t", index=False)
-                                    tree = Tree(tree)
-                                    tree.prune(df['ProteinID'].to_list(), preserve_branch_length=True)
-                                    # Convert tree to scientific names
-                                    scientificNameTree = make_scientific_name_tree(Tree(tree), df)
-                                    geneNameTree = make_gene_name_tree(Tree(tree), df)
-
-                                    # Organize data into columns [geneID, Speceies, Order, SpeciesCopyNum, OrderCopyNum]
-                                    species_count_dict = {f:df['Species'].to_list().count(f) for f in df['Species'].unique()}
-                                    df['SpeciesCopyNumber'] = [species_count_dict[f] for f in df['Species']]
-                                    
-                                    OrderCounts = {f:df['Order'].to_list().count(f) for f in df['Order'].unique()}
-                                    df['OrderCopyNumber'] = [OrderCounts[f] for f in df['Order']]
-                                    df = df[['Gene', 'Species', 'CommonName', 'Order', 'SpeciesCopyNumber', 'OrderCopyNumber', 'Chunk', 'GeneID', 'ProteinID']]  # Reorder columns
-                                    # Output files
-                                    writeTreeFile(Tree(tree).prune(df['ProteinID'].to_list(), preserve_branch_length=True), currChunkPidTreeFile)
-                                    writeTreeFile(scientificNameTree, currChunkSciNameTreeFile)
-                                    writeTreeFile(geneNameTree, currChunkGeneTreeFile)
-                                    df.to_csv(CountSummaryOutputFileName, sep='\t', index=False)
-                                    df.to_csv(currChunkSeqFile, sep="\t", index=False)
-                                    currentChunk += 1
-                                    break
-                                else:
-                                    # Remove species that are not in species of interest file
-                                    df = drop_non_species_of_interest(df, speciesDF)
-                                    # Sort by Order
-                                    df = df.sort_values(by='Order')
-                                    # If all species have NULL as gene, output null result file
-                                    if (len(df['Gene'].unique()) == 1) and (df['Gene'].unique()[0] == 'NULL'):
-                                        writeNullOutput(nullResult, df)
-                                        break
-                                    # This checks to make sure the newick tree is valid,
-                                    # if not then it will return a file saying the tree
-                                    # is malformed 
-                                    try:
-                                        tree = Tree(tree)
-                                        tree.prune(df['ProteinID'].to_list(), preserve_branch_length=True)
-                                    except TreeError:
-                                        writeTreeFile(tree, malformedTree)
-                                        currentChunk += 1
-                                        break
-                                    
-                                    # Convert tree leaves to scientific, common, and gene names
-                                    scientificNameTree = make_scientific_name_tree(tree.write(), df)
-                                    CommonNameTree = make_common_name_tree(scientificNameTree, speciesDF)
-                                    geneNameTree = make_gene_name_tree(tree.write(), df)
-
-                                    # Organize data into columns [geneID, Speceies, Order, SpeciesCopyNum, OrderCopyNum]
-                                    species_count_dict = {f:df['Species'].to_list().count(f) for f in df['Species'].unique()}
-                                    df['SpeciesCopyNumber'] = [species_count_dict[f] for f in df['Species']]
-                                    
-                                    OrderCounts = {f:df['Order'].to_list().count(f) for f in df['Order'].unique()}
-                                    df['OrderCopyNumber'] = [OrderCounts[f] for f in df['Order']]
-
-                                    # Reorder columns
-                                    df = df[['Gene', 'Species', 'CommonName', 'Order', 'SpeciesCopyNumber', 'OrderCopyNumber', 'Chunk', 'GeneID', 'ProteinID']]
-
-                                    # Output all files
-                                    writeTreeFile(tree.write(), currChunkPidTreeFile)
-                                    writeTreeFile(scientificNameTree, currChunkSciNameTreeFile)
-                                    writeTreeFile(CommonNameTree, currChunkCommonNameTreeFile)
-                                    writeTreeFile(geneNameTree, currChunkGeneTreeFile)
-                                    df.to_csv(CountSummaryOutputFileName, sep='\t', index=False)
-
-                                    # Output null file if no data present
-                                    if df.empty:
-                                        with open(nullResult, 'w') as oh:
-                                            oh.write('No data available')
-                                            currentChunk += 1
-                                            break
-                                    else:
-                                        df.to_csv(currChunkSeqFile, sep="\t", index=False)
-                                        currentChunk += 1
-                                        break
-                            else:
-                                continue
-                        break
-                # File tracker
-                # if count % 10000 == 0:
-                #     print(f"-- {count:,}/{len(geneFamily):,} --")
-                continue
-    # This section of code will output all species count data into a single file
-    countDir = OUTPUT / 'speciesCounts'
-    countFiles = [f for f in countDir.iterdir() if f.is_file()]
-    cumulative_df = pd.DataFrame(columns=['Gene', 'Species', 'CommonName', 'Order', 'SpeciesCopyNumber', 'OrderCopyNumber', 'Chunk', 'GeneID'])
+    # Every requested gene is matched against each family in a
+    # single pass over the file. Gene names are matched case
+    # insensitively, so keep a lowercase -> requested name(s) lookup.
+    genesOfInterest = {}
+    for geneOfInterest in dict.fromkeys(genesToLookUp):
+        genesOfInterest.setdefault(geneOfInterest.lower(), []).append(geneOfInterest)
+    geneOrder = {g:n for n, g in enumerate(dict.fromkeys(genesToLookUp))}
+    currentChunks = {g:1 for g in geneOrder}
+    print(f'--- Collecting results for {len(geneOrder):,} genes ---')
+    if INDEX:
+        # Seek straight to the families that contain a requested gene
+        conn = openFamilyIndex(INPUT, INDEX)
+        geneFamilies = readIndexedFamilies(INPUT, lookupFamilies(conn, genesOfInterest.keys()), metrics)
+        conn.close()
+    else:
+        geneFamilies = readFamilies(INPUT, metrics)
+    # 'read' covers reading + splitting the SEQ rows of every family
+    geneFamilies = metrics.timeIterator('read', geneFamilies)
+    # Chunk numbers are handed out here in file order, so the output
+    # does not depend on the number of workers or the order they finish.
+    if WORKERS > 1:
+        pool = ProcessPoolExecutor(max_workers=WORKERS, initializer=initFamilyWorker, initargs=(OUTPUT, speciesTable, bool(metrics)))
+    else:
+        pool = None
+        initFamilyWorker(OUTPUT, speciesTable, bool(metrics))
+    # Species counts are streamed into the cumulative output
+    # files as each family finishes
     cumulativeFileName = OUTPUT / 'CumulativeSpeciesCounts.tsv'
+    columnarFileName = OUTPUT / f'CumulativeSpeciesCounts.{COLUMNAR}' if COLUMNAR else None
+    cumulativeWriter = CumulativeCountWriter(cumulativeFileName, columnarFileName, COLUMNAR)
+    def writeFamilyResults(results):
+        countDFs, workerMetrics = results
+        metrics.merge(workerMetrics)
+        with metrics.stage('write_cumulative'):
+            for countDF in countDFs:
+                cumulativeWriter.write(countDF)
+        return
 
-    for f in countFiles:
-        fdf = pd.read_csv(f, sep='\t')
-        cumulative_df = pd.concat([cumulative_df, fdf])
+    pending = deque()
+    for family in geneFamilies:
+        metrics.add('families_read')
+        familyHits = [g for gene in familyGenes(family.seqdata) for g in genesOfInterest.get(gene, [])]
+        if not familyHits:
+            continue
+        metrics.add('families_matched')
+        hits = []
+        for geneOfInterest in sorted(familyHits, key=geneOrder.get):
+            print(f"Data found for {geneOfInterest}")
+            hits.append((geneOfInterest, currentChunks[geneOfInterest]))
+            currentChunks[geneOfInterest] += 1
+            continue
+        if pool is None:
+            writeFamilyResults(processFamilyHits(family.seqdata, family.tree, hits))
+            continue
+        pending.append(pool.submit(processFamilyHits, family.seqdata, family.tree, hits))
+        # Bound the number of families waiting on a worker
+        while len(pending) > WORKERS * 4:
+            writeFamilyResults(pending.popleft().result())
         continue
-
-    cumulative_df.to_csv(cumulativeFileName, sep='\t', index=False)
-    
+    while pending:
+        writeFamilyResults(pending.popleft().result())
+    if pool is not None:
+        pool.shutdown()
+    cumulativeWriter.close()
+    stopProfile(profiler, args.profile)
+    if metrics:
+        metrics.write(args.metrics, script='ensemblGeneFamilyHomologyFileParser.py', input=INPUT.as_posix(), workers=WORKERS)
+        print(f"Stage metrics written to {args.metrics}")
     return
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Thin client for familyQueryServer.py. Only the standard library is
+imported so a query starts in a fraction of a second. The arguments are
+the parser's: -g takes the same gene file (or a comma separated list of
+genes) and -o writes the same output files as
+ensemblGeneFamilyHomologyFileParser.py -o would. -i and -s are optional
+and only checked against the files the server was started with.
+
+    python familyQueryClient.py -g genesToLookUp.txt -o ./ensemblGeneFamilyResults/
+    python familyQueryClient.py -g BRCA2 --query counts
+    python familyQueryClient.py -g BRCA2 --query tree --chunk 1 --label CommonName
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+DEFAULT_SERVER = 'http://127.0.0.1:8642'
+
+
+def request(server, path, params=None, payload=None):
+    """GET (or POST payload to) server/path and return the decoded JSON"""
+    url = f"{server.rstrip('/')}{path}"
+    if params:
+        url = f"{url}?{urlencode(params, doseq=True)}"
+    data = None if payload is None else json.dumps(payload).encode()
+    req = Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(req) as response:
+            return json.loads(response.read())
+    except HTTPError as e:
+        sys.exit(f"{server} -- {json.loads(e.read() or b'{}').get('error', e.reason)}")
+    except URLError as e:
+        sys.exit(f"Could not reach {server} ({e.reason}) -- start it with familyQueryServer.py")
+
+
+def readGenes(INPUT_GENE):
+    """Genes from a gene file (one per line) or a comma separated list"""
+    if Path(INPUT_GENE).is_file():
+        return [g.strip() for g in open(INPUT_GENE).readlines()]
+    return [g.strip() for g in INPUT_GENE.split(',')]
+
+
+def checkServerInputs(server, INPUT, SPECIES):
+    """Refuse to answer from a server started on other files"""
+    health = request(server, '/health')
+    for name, given, served in (('emf file', INPUT, health['input']), ('species file', SPECIES, health['species'])):
+        if given is not None and Path(given).resolve().as_posix() != served:
+            sys.exit(f"The server at {server} was started with {name} {served}, not {given}")
+        continue
+    return
+
+
+def cell(value):
+    return '' if value is None else str(value)
+
+
+def printTable(columns, rows):
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join(cell(v) for v in row))
+        continue
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a running familyQueryServer.py')
+    parser.add_argument(
+        '-g',
+        '--INPUT_GENE',
+        type=str,
+        action='store',
+        required=True,
+        help="Gene file (one gene per line) or comma separated list of genes",
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        type=str,
+        action='store',
+        default=None,
+        help='Write the parser output files here instead of printing a query',
+    )
+    parser.add_argument(
+        '-i',
+        '--input',
+        type=str,
+        action='store',
+        default=None,
+        help="emf file the server must have been started with (optional check)",
+    )
+    parser.add_argument(
+        '-s',
+        '--species',
+        type=str,
+        action='store',
+        default=None,
+        help='Species file the server must have been started with (optional check)',
+    )
+    parser.add_argument(
+        '--query',
+        type=str,
+        action='store',
+        choices=['counts', 'families', 'tree'],
+        default='counts',
+        help='What to print when no -o is given [default: counts]',
+    )
+    parser.add_argument('--chunk', type=int, action='store', default=None, help='Only this chunk (family) of the gene for --query tree')
+    parser.add_argument(
+        '--label',
+        type=str,
+        action='store',
+        choices=['ProteinID', 'ScientificName', 'CommonName', 'GeneName'],
+        default='ProteinID',
+        help='Leaf labels for --query tree [default: ProteinID]',
+    )
+    parser.add_argument('--server', type=str, action='store', default=DEFAULT_SERVER, help=f'Server URL [default: {DEFAULT_SERVER}]')
+    args = parser.parse_args()
+    SERVER = args.server
+    genes = list(dict.fromkeys(readGenes(args.INPUT_GENE)))
+    if (args.input is not None) or (args.species is not None):
+        checkServerInputs(SERVER, args.input, args.species)
+
+    if args.output:
+        result = request(SERVER, '/parse', payload={'genes': genes, 'output': Path(args.output).resolve().as_posix()})
+        for gene, chunks in result['chunks'].items():
+            print(f"{gene}: {chunks:,} chunks" if chunks else f"{gene}: no data found")
+            continue
+        print(f"Results written to {result['output']} in {result['seconds']:.3f}s")
+    elif args.query == 'counts':
+        result = request(SERVER, '/species-counts', {'gene': genes})
+        printTable(result['columns'], result['rows'])
+    elif args.query == 'families':
+        result = request(SERVER, '/families', {'gene': genes})
+        rows = []
+        for family in result['families']:
+            for member in family['members']:
+                rows.append([family['gene'], family['chunk'], family['status'], *member])
+                continue
+            continue
+        printTable(['QueryGene', 'Chunk', 'Status'] + result['columns'], rows)
+    else:
+        for gene in genes:
+            result = request(SERVER, '/tree', {'gene': gene, 'chunk': args.chunk, 'label': args.label} if args.chunk else {'gene': gene, 'label': args.label})
+            for tree in result['trees']:
+                print(f"# {gene} chunk_{tree['chunk']} ({tree['status']})")
+                print(tree['newick'] or '')
+                continue
+            continue
+    return
+
+
+if __name__ == '__main__':
+    main()
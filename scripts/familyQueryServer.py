@@ -0,0 +1,373 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Long running local query server for interactive curation. pandas, ete3
+and the species table are loaded once, the emf file is opened through
+its family index (built on first use) and memory mapped, and every
+query after that is answered without paying the parser's startup again.
+Processed families are kept in an LRU cache, so asking for the trees of
+a gene whose counts were just shown costs nothing.
+
+    python familyQueryServer.py -i Compara.102.protein_default.emf -s speciesNameConverter.xlsx
+    python familyQueryClient.py -g BRCA2 --query counts
+
+Compressed emf files cannot be memory mapped -- their families are
+read into memory once at startup instead, which needs enough RAM to hold
+every named family of the file.
+
+Endpoints (JSON responses, gene may be repeated):
+    GET  /health
+    GET  /families?gene=<gene>                  members + status of each family (chunk)
+    GET  /species-counts?gene=<gene>            CumulativeSpeciesCounts.tsv rows
+    GET  /tree?gene=<gene>[&chunk=<n>][&label=<ProteinID|ScientificName|CommonName|GeneName>]
+    POST /parse {"genes": [...], "output": "<dir>"}
+         writes the same output files as ensemblGeneFamilyHomologyFileParser.py -o <dir>
+
+The server only listens on 127.0.0.1 by default -- /parse writes to any
+directory the server user can write to.
+"""
+import argparse
+from collections import OrderedDict
+import json
+import mmap
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+from ensemblGeneFamilyHomologyFileParser import (
+    COUNT_COLUMNS, CumulativeCountWriter, FamilyResult, buildFamilyDataFrame, buildFamilyIndex,
+    defaultIndexPath, familyGenes, isGzipFile, iterFamilies, loadSpeciesTable, openFamilyIndex,
+    readFamilies, summarizeFamily, writeFamilyResult,
+)
+
+DEFAULT_PORT = 8642
+TREE_LABELS = ['ProteinID', 'ScientificName', 'CommonName', 'GeneName']
+
+
+class QueryError(Exception):
+    """Bad request -- sent back to the client as a 400 response"""
+    pass
+
+
+########################## Family Store ##########################
+class FamilyStore:
+    """Lowercase gene name -> [(family number, GeneFamily)] in file order.
+    Plain emf files are read through a memory map + the family index,
+    compressed ones are held in memory."""
+    def __init__(self, INPUT, INDEX=None):
+        self.INPUT = Path(INPUT)
+        self.mm = None
+        self.geneFamilies = {}
+        if isGzipFile(self.INPUT):
+            self.indexPath = None
+            self.loadFamilies()
+        else:
+            self.indexPath = Path(INDEX) if INDEX else defaultIndexPath(self.INPUT)
+            self.openIndex()
+        return
+
+    def openIndex(self):
+        try:
+            conn = openFamilyIndex(self.INPUT, self.indexPath)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"Building family index {self.indexPath} ({e})")
+            buildFamilyIndex(self.INPUT, self.indexPath)
+            conn = openFamilyIndex(self.INPUT, self.indexPath)
+        rows = conn.execute(
+            'SELECT DISTINCT m.name, f.family_id, f.offset, f.length FROM members m '
+            'JOIN families f ON f.family_id = m.family_id '
+            "WHERE m.field = 'Gene' ORDER BY f.family_id"
+        )
+        for name, familyID, offset, length in rows:
+            self.geneFamilies.setdefault(name, []).append((familyID, offset, length))
+            continue
+        conn.close()
+        self.fh = open(self.INPUT, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return
+
+    def loadFamilies(self):
+        """Hold every family with a named member. familyGenes() reports
+        unnamed members as 'null', which -- like the family index -- is
+        not kept as a gene."""
+        for familyID, family in enumerate(readFamilies(self.INPUT)):
+            for gene in familyGenes(family.seqdata) - {'null'}:
+                self.geneFamilies.setdefault(gene, []).append((familyID, family))
+                continue
+            continue
+        return
+
+    def families(self, gene):
+        """[(family number, GeneFamily)] of every family gene is found in"""
+        entries = self.geneFamilies.get(gene.lower(), [])
+        if self.mm is None:
+            return entries
+        families = []
+        for familyID, offset, length in entries:
+            for family in iterFamilies(self.mm[offset:offset+length].decode().split("\n")):
+                families.append((familyID, family))
+                continue
+            continue
+        return families
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.fh.close()
+        return
+
+
+########################## Query Server ##########################
+class FamilyQueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, speciesTable, SPECIES=None, cacheGenes=1024):
+        super().__init__(address, FamilyQueryHandler)
+        self.store = store
+        self.speciesTable = speciesTable
+        self.SPECIES = Path(SPECIES).resolve().as_posix() if SPECIES else None
+        self.cacheGenes = cacheGenes
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stats = {'queries': 0, 'cache_hits': 0}
+        return
+
+    def geneChunks(self, gene):
+        """[(family number, chunk number, GeneFamily, FamilyResult)] for a
+        gene, numbered the way the parser numbers its chunk directories"""
+        with self.lock:
+            self.stats['queries'] += 1
+            if gene in self.cache:
+                self.stats['cache_hits'] += 1
+                self.cache.move_to_end(gene)
+                return self.cache[gene]
+        chunks = []
+        for currentChunk, (familyID, family) in enumerate(self.store.families(gene), 1):
+            chunks.append((familyID, currentChunk, family, self.summarize(family, gene, currentChunk)))
+            continue
+        with self.lock:
+            self.cache[gene] = chunks
+            while len(self.cache) > self.cacheGenes:
+                self.cache.popitem(last=False)
+        return chunks
+
+    def summarize(self, family, gene, currentChunk):
+        try:
+            df = buildFamilyDataFrame(family.seqdata, self.speciesTable)
+        except ValueError as e:
+            return FamilyResult('unreadable', None, None, str(e))
+        try:
+            return summarizeFamily(df, family.tree, gene, currentChunk, self.speciesTable)
+        except Exception as e:
+            # A family the parser would stop on must not take the server down
+            return FamilyResult('error', None, None, f"{type(e).__name__}: {e}")
+
+    def health(self):
+        return {
+            'input': self.store.INPUT.resolve().as_posix(),
+            'index': self.store.indexPath.resolve().as_posix() if self.store.indexPath else None,
+            'species': self.SPECIES,
+            'genes': len(self.store.geneFamilies),
+            'cached_genes': len(self.cache),
+            'uptime_seconds': round(time.time() - self.started, 1),
+            **self.stats,
+        }
+
+    def familiesQuery(self, genes):
+        families = []
+        for gene in genes:
+            for familyID, currentChunk, family, result in self.geneChunks(gene):
+                families.append({
+                    'gene': gene,
+                    'chunk': currentChunk,
+                    'family': familyID,
+                    'status': result.status,
+                    'error': result.tree if result.status in ('unreadable', 'error') else None,
+                    'members': [(l[1], l[2], l[7], l[8] if len(l) > 8 else None) for l in family.seqdata],
+                    'species_of_interest': len(result.df) if result.status == 'ok' else 0,
+                })
+                continue
+            continue
+        return {'columns': ['Species', 'ProteinID', 'GeneID', 'Gene'], 'families': families}
+
+    def speciesCountsQuery(self, genes):
+        rows = []
+        for gene in genes:
+            for _, _, _, result in self.geneChunks(gene):
+                if result.status == 'ok':
+                    rows.extend(json.loads(result.df[COUNT_COLUMNS].to_json(orient='split', index=False))['data'])
+                continue
+            continue
+        return {'columns': COUNT_COLUMNS, 'rows': rows}
+
+    def treeQuery(self, gene, chunk=None, label='ProteinID'):
+        if label not in TREE_LABELS:
+            raise QueryError(f"label must be one of {', '.join(TREE_LABELS)}")
+        trees = []
+        for _, currentChunk, _, result in self.geneChunks(gene):
+            if chunk is not None and currentChunk != chunk:
+                continue
+            trees.append({
+                'gene': gene,
+                'chunk': currentChunk,
+                'status': result.status,
+                'newick': result.trees.get(label) if result.status == 'ok' else None,
+            })
+            continue
+        return {'label': label, 'trees': trees}
+
+    def parseQuery(self, genes, OUTPUT):
+        """Write the parser's output files for genes into OUTPUT. Families
+        are written in file order like a parser run over the same gene list."""
+        OUTPUT = Path(OUTPUT)
+        OUTPUT.mkdir(parents=True, exist_ok=True)
+        geneOrder = {g:n for n, g in enumerate(genes)}
+        chunks = []
+        for gene in genes:
+            chunks.extend((familyID, geneOrder[gene], gene, currentChunk, result) for familyID, currentChunk, _, result in self.geneChunks(gene))
+            continue
+        chunks.sort(key=lambda c: (c[0], c[1]))
+        written = {gene: 0 for gene in genes}
+        with CumulativeCountWriter(OUTPUT / 'CumulativeSpeciesCounts.tsv') as cumulativeWriter:
+            for _, _, gene, currentChunk, result in chunks:
+                if result.status not in ('ok', 'null', 'malformed'):
+                    continue
+                countDF = writeFamilyResult(result, gene, currentChunk, OUTPUT, self.speciesTable)
+                if countDF is not None:
+                    cumulativeWriter.write(countDF)
+                written[gene] += 1
+                continue
+        return {'output': OUTPUT.resolve().as_posix(), 'chunks': written}
+
+
+class FamilyQueryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def sendJSON(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def respond(self, query):
+        """Run query() and send its result, timing it"""
+        start = time.perf_counter()
+        try:
+            data = query()
+        except QueryError as e:
+            self.sendJSON(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.sendJSON(500, {'error': f"{type(e).__name__}: {e}"})
+            return
+        data['seconds'] = round(time.perf_counter() - start, 6)
+        self.sendJSON(200, data)
+        return
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        params = parse_qs(url.query)
+        genes = list(dict.fromkeys(params.get('gene', [])))
+        if path == '/health':
+            self.respond(self.server.health)
+            return
+        if path not in ('/families', '/species-counts', '/tree'):
+            self.sendJSON(404, {'error': 'page not found'})
+            return
+        if not genes:
+            self.sendJSON(400, {'error': 'no gene given'})
+            return
+        if path == '/families':
+            self.respond(lambda: self.server.familiesQuery(genes))
+        elif path == '/species-counts':
+            self.respond(lambda: self.server.speciesCountsQuery(genes))
+        else:
+            try:
+                chunk = int(params['chunk'][0]) if 'chunk' in params else None
+            except ValueError:
+                self.sendJSON(400, {'error': 'chunk must be a number'})
+                return
+            label = params.get('label', ['ProteinID'])[0]
+            self.respond(lambda: self.server.treeQuery(genes[0], chunk, label))
+        return
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.sendJSON(400, {'error': 'request body is not JSON'})
+            return
+        if urlsplit(self.path).path.rstrip('/') != '/parse':
+            self.sendJSON(404, {'error': 'page not found'})
+            return
+        genes = list(dict.fromkeys(payload.get('genes', [])))
+        if not genes or not payload.get('output'):
+            self.sendJSON(400, {'error': 'genes and output are required'})
+            return
+        self.respond(lambda: self.server.parseQuery(genes, payload['output']))
+        return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve gene family, species count and tree queries from memory')
+    parser.add_argument(
+        '-i',
+        '--input',
+        type=str,
+        action='store',
+        required=True,
+        help="Ensembl emf file",
+    )
+    parser.add_argument(
+        '-s',
+        '--species',
+        type=str,
+        action='store',
+        default=None,
+        help='Species of interest file (same as the parser\'s -s)',
+    )
+    parser.add_argument(
+        '--index',
+        type=str,
+        action='store',
+        default=None,
+        help="Family index [default: <input>.idx.sqlite, built if missing or out of date]",
+    )
+    parser.add_argument('--host', type=str, action='store', default='127.0.0.1', help='Address to listen on [default: 127.0.0.1]')
+    parser.add_argument('--port', type=int, action='store', default=DEFAULT_PORT, help=f'Port to listen on [default: {DEFAULT_PORT}]')
+    parser.add_argument(
+        '--cache-genes',
+        type=int,
+        action='store',
+        default=1024,
+        help='Number of genes whose processed families are kept in memory',
+    )
+    args = parser.parse_args()
+    start = time.perf_counter()
+    speciesTable = loadSpeciesTable(args.species)
+    store = FamilyStore(args.input, args.index)
+    server = FamilyQueryServer((args.host, args.port), store, speciesTable, args.species, max(1, args.cache_genes))
+    print(f"Loaded {len(store.geneFamilies):,} genes in {time.perf_counter() - start:.1f}s -- serving on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    store.close()
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+faidx style random access to plain or bgzip compressed FASTA files.
+
+Indexes are written next to the FASTA file and reused until the FASTA
+file changes:
+    <fasta>.fai         -- samtools faidx index (name, length, offset, linebases, linewidth)
+    <fasta>.gzi         -- samtools bgzip block index (bgzip files only)
+    <fasta>.hdr.tsv     -- the rest of each header line (Ensembl gene ID, location, ...)
+    <fasta>.index.json  -- path, size + mtime of the FASTA the index was built from
+A FASTA replaced by a download that kept the server's (older) file time
+is still noticed, as its size or mtime no longer match.
+
+Sequences are read from a memory map of the file. For bgzip files only
+the blocks that overlap the requested record are decompressed.
+"""
+from bisect import bisect_right
+from functools import lru_cache
+import gzip
+import json
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+########################## BGZF Functions ##########################
+def isGzipFile(path):
+    with open(path, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+def isBgzipFile(path):
+    """bgzip blocks are gzip members with a 'BC' extra subfield"""
+    with open(path, 'rb') as fh:
+        header = fh.read(18)
+    return (len(header) == 18) and (header[:2] == GZIP_MAGIC) and bool(header[3] & 4) and (header[12:14] == b'BC')
+
+
+def bgzfBlockSize(mm, offset):
+    """Total size of the bgzip block starting at offset"""
+    if mm[offset+12:offset+14] != b'BC':
+        raise ValueError(f"Malformed bgzip block at offset {offset:,}")
+    return struct.unpack('<H', mm[offset+16:offset+18])[0] + 1
+
+
+def buildBgzfBlockIndex(mm):
+    """Return the [(compressed offset, uncompressed offset)] start of every
+    bgzip block. Only block headers + trailers are read, nothing is
+    decompressed."""
+    blocks = []
+    compressedOffset = 0
+    uncompressedOffset = 0
+    while compressedOffset < len(mm):
+        blockSize = bgzfBlockSize(mm, compressedOffset)
+        blocks.append((compressedOffset, uncompressedOffset))
+        # ISIZE -- uncompressed size of the block -- is the last 4 bytes
+        uncompressedOffset += struct.unpack('<I', mm[compressedOffset+blockSize-4:compressedOffset+blockSize])[0]
+        compressedOffset += blockSize
+    return blocks
+
+
+def writeGziFile(blocks, path):
+    """samtools .gzi layout: entry count followed by (compressed, uncompressed)
+    offset pairs for every block after the first"""
+    entries = blocks[1:]
+    with open(path, 'wb') as oh:
+        oh.write(struct.pack('<Q', len(entries)))
+        for compressedOffset, uncompressedOffset in entries:
+            oh.write(struct.pack('<QQ', compressedOffset, uncompressedOffset))
+    return
+
+
+def readGziFile(path):
+    data = Path(path).read_bytes()
+    count = struct.unpack('<Q', data[:8])[0]
+    values = struct.unpack(f'<{count*2}Q', data[8:8+count*16])
+    return [(0, 0)] + list(zip(values[0::2], values[1::2]))
+
+
+def readBgzfBlock(mm, compressedOffset):
+    blockSize = bgzfBlockSize(mm, compressedOffset)
+    return zlib.decompress(mm[compressedOffset:compressedOffset+blockSize], 31)
+
+
+def readBgzfRange(mm, blocks, blockStarts, start, end, readBlock=None):
+    """Decompress uncompressed bytes [start, end) from the bgzip blocks
+    that overlap them. blocks is the output of buildBgzfBlockIndex() and
+    blockStarts the uncompressed offset of each block. readBlock(compressed
+    offset) can be given to reuse already decompressed blocks."""
+    readBlock = readBlock or (lambda compressedOffset: readBgzfBlock(mm, compressedOffset))
+    n = bisect_right(blockStarts, start) - 1
+    data = []
+    firstBlockStart = blockStarts[n]
+    blockEnd = firstBlockStart
+    while (blockEnd < end) and (n < len(blocks)):
+        block = readBlock(blocks[n][0])
+        data.append(block)
+        blockEnd += len(block)
+        n += 1
+    return b''.join(data)[start-firstBlockStart:end-firstBlockStart]
+
+
+########################## FASTA Index ##########################
+def fileStats(path):
+    """Resolved path, size + mtime of path -- what a cache built from it records"""
+    stats = os.stat(path)
+    return {'source': Path(path).resolve().as_posix(), 'size': stats.st_size, 'mtime_ns': stats.st_mtime_ns}
+
+
+def indexIsCurrent(fastaPath, sourcePath, indexPaths):
+    """Every index file exists and sourcePath records this version of fastaPath"""
+    if not (sourcePath.exists() and all(p.exists() for p in indexPaths)):
+        return False
+    try:
+        return json.loads(sourcePath.read_text()) == fileStats(fastaPath)
+    except ValueError:
+        return False
+
+
+def scanFasta(fh):
+    """Scan a binary FASTA stream, yielding
+    (name, header, length, offset, linebases, linewidth) per record"""
+    offset = 0
+    record = None
+    for line in fh:
+        lineLength = len(line)
+        if line.startswith(b'>'):
+            if record is not None:
+                yield tuple(record)
+            header = line[1:].rstrip(b'\r\n').decode()
+            record = [header.split(' ', 1)[0], header, 0, offset + lineLength, 0, 0]
+        elif record is not None:
+            bases = len(line.rstrip(b'\r\n'))
+            if record[4] == 0:
+                record[4], record[5] = bases, lineLength
+            record[2] += bases
+        offset += lineLength
+        continue
+    if record is not None:
+        yield tuple(record)
+    return
+
+
+def buildFastaIndex(fastaPath):
+    """Write the .fai + .hdr.tsv (and .gzi for bgzip) files for fastaPath.
+    The .index.json is written last, so an interrupted build is never used."""
+    fastaPath = Path(fastaPath)
+    sourcePath = Path(f"{fastaPath}.index.json")
+    if sourcePath.exists():
+        os.remove(sourcePath)
+    compressed = isGzipFile(fastaPath)
+    if compressed and not isBgzipFile(fastaPath):
+        raise ValueError(f"{fastaPath} is gzip but not bgzip compressed -- recompress it with bgzip for random access")
+    opener = gzip.open if compressed else open
+    with opener(fastaPath, 'rb') as fh, open(f"{fastaPath}.fai", 'w') as fai, open(f"{fastaPath}.hdr.tsv", 'w') as hdr:
+        for name, header, length, offset, linebases, linewidth in scanFasta(fh):
+            fai.write(f"{name}\t{length}\t{offset}\t{linebases}\t{linewidth}\n")
+            hdr.write(f"{name}\t{header.replace(chr(9), ' ')}\n")
+            continue
+    if compressed:
+        with open(fastaPath, 'rb') as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                writeGziFile(buildBgzfBlockIndex(mm), f"{fastaPath}.gzi")
+    sourcePath.write_text(json.dumps(fileStats(fastaPath)))
+    return
+
+
+class FastaIndex:
+    """Random access to the records of an indexed FASTA file. The
+    index files are (re)built when missing or built from another
+    version of the FASTA."""
+    def __init__(self, fastaPath):
+        self.path = Path(fastaPath)
+        faiPath = Path(f"{self.path}.fai")
+        hdrPath = Path(f"{self.path}.hdr.tsv")
+        gziPath = Path(f"{self.path}.gzi")
+        self.compressed = isGzipFile(self.path)
+        indexPaths = [faiPath, hdrPath, gziPath] if self.compressed else [faiPath, hdrPath]
+        if not indexIsCurrent(self.path, Path(f"{self.path}.index.json"), indexPaths):
+            buildFastaIndex(self.path)
+        self.records = {}
+        with open(faiPath) as fh:
+            for line in fh:
+                name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')
+                self.records[name] = (int(length), int(offset), int(linebases), int(linewidth))
+                continue
+        self.headers = {}
+        with open(hdrPath) as fh:
+            for line in fh:
+                name, header = line.rstrip('\n').split('\t', 1)
+                self.headers[name] = header
+                continue
+        self.fh = open(self.path, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.compressed:
+            self.blocks = readGziFile(gziPath)
+            self.blockStarts = [b[1] for b in self.blocks]
+            # Neighbouring records usually share blocks
+            self.readBlock = lru_cache(maxsize=64)(lambda compressedOffset: readBgzfBlock(self.mm, compressedOffset))
+        return
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def fetch(self, name):
+        """Return the sequence of record name"""
+        length, offset, linebases, linewidth = self.records[name]
+        if length == 0:
+            return ''
+        # Bytes spanned by the sequence, including line endings
+        span = ((length - 1) // linebases) * linewidth + ((length - 1) % linebases) + 1
+        if self.compressed:
+            data = readBgzfRange(self.mm, self.blocks, self.blockStarts, offset, offset + span, self.readBlock)
+        else:
+            data = self.mm[offset:offset+span]
+        return data.replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def close(self):
+        if self.compressed:
+            self.readBlock.cache_clear()
+        self.mm.close()
+        self.fh.close()
+        return
+
+
+########################## FASTA Writer ##########################
+def wrapSequence(seq, width=80):
+    """Break seq into lines of width characters (no trailing newline)"""
+    return '\n'.join([seq[i:i+width] for i in range(0, len(seq), width)])
+
+
+class MultiFastaWriter:
+    """Appends records to a multi-FASTA file through a large write buffer
+    and keeps its .fai index in step. Index lines are held back until the
+    FASTA records they point to have been flushed, so the .fai is never
+    ahead of the FASTA. Reopening an existing file resumes it: records
+    already in the .fai are reported by `name in writer`, and anything
+    written after the last indexed record (an interrupted write) is cut
+    off before new records are appended."""
+    def __init__(self, path, width=80, overwrite=False, bufferSize=1 << 20):
+        self.path = Path(path)
+        self.faiPath = Path(f"{self.path}.fai")
+        self.width = width
+        self.names = set()
+        self.faiLines = []
+        self.faiBufferSize = max(1, bufferSize // 16)
+        self.faiBuffered = 0
+        end = 0
+        if (not overwrite) and self.path.exists() and self.faiPath.exists():
+            end = self.resume()
+        else:
+            self.path.write_bytes(b'')
+            self.faiPath.write_text('')
+        self.offset = end
+        self.fh = open(self.path, 'ab', buffering=bufferSize)
+        self.fai = open(self.faiPath, 'a')
+        return
+
+    def resume(self):
+        """Keep the .fai records that lie within the FASTA (a crash can
+        leave a partial last line), rewrite the .fai to them and cut the
+        FASTA back to the end of the last one. Returns that end offset."""
+        size = self.path.stat().st_size
+        end = 0
+        valid = []
+        with open(self.faiPath) as fh:
+            for line in fh:
+                try:
+                    name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')
+                    length, offset, linebases, linewidth = int(length), int(offset), int(linebases), int(linewidth)
+                except ValueError:
+                    break
+                # End of the body write() emitted, its final newline included
+                if length:
+                    recordEnd = offset + ((length - 1) // linebases) * linewidth + ((length - 1) % linebases) + 2
+                else:
+                    recordEnd = offset + 1
+                # Records are appended in order -- stop at the first one
+                # the FASTA does not fully hold
+                if (not line.endswith('\n')) or recordEnd > size:
+                    break
+                self.names.add(name)
+                valid.append(line)
+                end = max(end, recordEnd)
+                continue
+        self.faiPath.write_text(''.join(valid))
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(end)
+        return end
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def write(self, name, seq):
+        header = f">{name}\n".encode()
+        body = f"{wrapSequence(seq, self.width)}\n".encode()
+        seqOffset = self.offset + len(header)
+        self.fh.write(header)
+        self.fh.write(body)
+        line = f"{name}\t{len(seq)}\t{seqOffset}\t{min(self.width, len(seq))}\t{min(self.width, len(seq)) + 1}\n"
+        self.faiLines.append(line)
+        self.faiBuffered += len(line)
+        self.offset = seqOffset + len(body)
+        self.names.add(name)
+        if self.faiBuffered >= self.faiBufferSize:
+            self.flush()
+        return
+
+    def flush(self):
+        """Flush the FASTA, then the index lines of the records just flushed"""
+        self.fh.flush()
+        self.fai.write(''.join(self.faiLines))
+        self.fai.flush()
+        self.faiLines = []
+        self.faiBuffered = 0
+        return
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+        self.fai.close()
+        return
@@ -3,18 +3,389 @@ Author: Andrew Harris
 Python 3.8 
 
 Dependency install commands
-conda install ensembl-rest or pip install ensembl-rest
+conda install requests or pip install requests
 conda install pandas or pip install pandas
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
 import logging
 import os
 from pathlib import Path
-import textwrap
+import random
+import sqlite3
+import sys
+import threading
+import time
 
 ## Dependencies
-import ensembl_rest
 import pandas as pd
+import requests
+
+from fastaIndex import FastaIndex, MultiFastaWriter, wrapSequence
+from stageMetrics import NULL_METRICS, addMetricsArguments, makeMetrics, startProfile, stopProfile
+
+ENSEMBL_REST_SERVER = 'https://rest.ensembl.org'
+# POST /sequence/id accepts at most 50 IDs per request
+ENSEMBL_MAX_POST_IDS = 50
+
+########################## Fetch Functions ##########################
+"""
+Batches of IDs are POSTed to /sequence/id from a small thread pool.
+Every request (including retries) first takes a token from a shared
+token bucket so the run stays under Ensembl's published limit of 15
+requests per second. Each thread keeps its own keep-alive session.
+429 responses are retried after their Retry-After header, and 5xx
+responses + connection errors are retried with exponential backoff.
+"""
+ENSEMBL_REQUESTS_PER_SECOND = 15
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    """Raised when a request still fails after all retries"""
+    pass
+
+
+class TokenBucket:
+    """Thread safe token bucket -- acquire() blocks until a token
+    is available. Tokens refill at rate per second up to capacity."""
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        return
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_threadLocal = threading.local()
+
+
+def threadSession():
+    """One keep-alive requests session per fetch thread"""
+    if not hasattr(_threadLocal, 'session'):
+        _threadLocal.session = requests.Session()
+        _threadLocal.session.headers.update({'Content-Type': 'application/json', 'Accept': 'application/json'})
+    return _threadLocal.session
+
+
+def batchIDs(ids, batchSize):
+    """Split ids into lists of at most batchSize"""
+    return [ids[i:i+batchSize] for i in range(0, len(ids), batchSize)]
+
+
+def retryDelay(response, attempt, backoff):
+    """Seconds to wait before the next attempt -- Retry-After for
+    rate limited responses, otherwise exponential backoff + jitter"""
+    if (response is not None) and (response.status_code == 429):
+        try:
+            return float(response.headers.get('Retry-After', ''))
+        except ValueError:
+            pass
+    return (backoff * (2 ** attempt)) + random.uniform(0, backoff)
+
+
+def requestWithRetries(method, url, limiter, retries, backoff, timeout, metrics=NULL_METRICS, **kwargs):
+    """Send a request through the rate limiter, retrying rate limited,
+    server error and connection failures"""
+    session = threadSession()
+    for attempt in range(retries + 1):
+        with metrics.stage('rate_limit_wait'):
+            limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            response, reason = None, f"{type(e).__name__}: {e}"
+            metrics.add('connection_errors')
+        else:
+            metrics.observe('request_latency_ms', round((time.perf_counter() - start) * 1000, 3))
+            metrics.add('requests')
+            metrics.add(f'http_{response.status_code}')
+            metrics.add('bytes_sent', len(response.request.body or b''))
+            metrics.add('bytes_received', len(response.content))
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            reason = f"HTTP {response.status_code}"
+        if attempt < retries:
+            metrics.add('retries')
+            with metrics.stage('retry_wait'):
+                time.sleep(retryDelay(response, attempt, backoff))
+        continue
+    raise FetchError(f"{reason} after {retries + 1} attempts")
+
+
+def postWithRetries(server, ids, limiter, retries, backoff, timeout, metrics=NULL_METRICS):
+    """POST ids to /sequence/id"""
+    return requestWithRetries('POST', f"{server}/sequence/id", limiter, retries, backoff, timeout, metrics, json={'ids': ids})
+
+
+def fetchSequenceBatch(server, ids, limiter, retries=5, backoff=0.5, timeout=60, metrics=NULL_METRICS):
+    """POST a batch of stable IDs to /sequence/id and return
+    {stable ID: result}. Ensembl rejects the whole request with
+    a 400 if any ID is unknown, so a rejected batch is split in
+    half until the unknown IDs are isolated and dropped."""
+    response = postWithRetries(server, ids, limiter, retries, backoff, timeout, metrics)
+    if response.status_code == 400:
+        if len(ids) == 1:
+            metrics.add('unknown_ids')
+            return {}
+        metrics.add('batch_splits')
+        half = len(ids) // 2
+        results = fetchSequenceBatch(server, ids[:half], limiter, retries, backoff, timeout, metrics)
+        results.update(fetchSequenceBatch(server, ids[half:], limiter, retries, backoff, timeout, metrics))
+        return results
+    response.raise_for_status()
+    results = {}
+    for result in response.json():
+        results[result.get('query', result['id'])] = result
+        continue
+    return results
+
+
+def fetchSequences(ids, server=ENSEMBL_REST_SERVER, batchSize=ENSEMBL_MAX_POST_IDS, workers=4, rate=ENSEMBL_REQUESTS_PER_SECOND, retries=5, backoff=0.5, onResults=None, metrics=NULL_METRICS, limiter=None):
+    """Fetch the sequences of ids, returning ({stable ID: result}, {stable ID: error}).
+    IDs that Ensembl does not know are in neither dictionary, IDs whose
+    batch could not be fetched are in the error dictionary. onResults is
+    called from the calling thread with the results of each finished batch.
+    Pass limiter to share a TokenBucket with other requests of the run."""
+    ids = [i for i in dict.fromkeys(ids) if i != 'NULL']
+    limiter = limiter or TokenBucket(rate)
+    results = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(fetchSequenceBatch, server, batch, limiter, retries, backoff, 60, metrics): batch for batch in batchIDs(ids, batchSize)}
+        for future in as_completed(futures):
+            try:
+                batchResults = future.result()
+            except (FetchError, requests.RequestException) as e:
+                failures.update({i:str(e) for i in futures[future]})
+                continue
+            results.update(batchResults)
+            if onResults is not None:
+                onResults(batchResults)
+            continue
+    return results, failures
+
+
+########################## Sequence Cache ##########################
+DEFAULT_CACHE = Path.home() / '.cache' / 'fetchEnsemblSequences' / 'sequences.sqlite'
+
+
+class SequenceCache:
+    """SQLite cache of fetched sequences keyed by stable ID and Ensembl
+    release. Once the stored sequences grow past maxBytes, the least
+    recently used entries are evicted."""
+    def __init__(self, path, maxBytes):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.maxBytes = maxBytes
+        # Several fetchers (e.g. runPipeline.py genes) may share one cache
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS sequences ('
+            'stable_id TEXT, release TEXT, seq TEXT, desc TEXT, molecule TEXT, '
+            'size INTEGER, last_access REAL, PRIMARY KEY (stable_id, release))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS sequences_last_access ON sequences (last_access)')
+        self.conn.commit()
+        return
+
+    def get(self, ids, release):
+        """Return {stable ID: result} for the cached ids"""
+        cached = {}
+        for batch in batchIDs(list(ids), 500):
+            placeholders = ','.join('?' * len(batch))
+            rows = self.conn.execute(
+                f'SELECT stable_id, seq, desc, molecule FROM sequences WHERE release = ? AND stable_id IN ({placeholders})',
+                [release] + batch,
+            )
+            for stableID, seq, desc, molecule in rows:
+                cached[stableID] = {'id': stableID, 'query': stableID, 'seq': seq, 'desc': desc, 'molecule': molecule}
+            continue
+        self.conn.executemany(
+            'UPDATE sequences SET last_access = ? WHERE stable_id = ? AND release = ?',
+            [(time.time(), i, release) for i in cached],
+        )
+        self.conn.commit()
+        return cached
+
+    def put(self, results, release):
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO sequences VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(i, release, r['seq'], r.get('desc'), r.get('molecule'), len(r['seq']), now) for i, r in results.items()],
+        )
+        self.conn.commit()
+        self.evict()
+        return
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in maxBytes"""
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM sequences').fetchone()[0]
+        if total <= self.maxBytes:
+            return
+        toDelete = []
+        for stableID, release, size in self.conn.execute('SELECT stable_id, release, size FROM sequences ORDER BY last_access'):
+            if total <= self.maxBytes:
+                break
+            toDelete.append((stableID, release))
+            total -= size
+            continue
+        self.conn.executemany('DELETE FROM sequences WHERE stable_id = ? AND release = ?', toDelete)
+        self.conn.commit()
+        return
+
+    def close(self):
+        self.conn.close()
+        return
+
+
+def ensemblRelease(server, limiter, retries=5, backoff=0.5, metrics=NULL_METRICS):
+    """Current release of the REST server (GET /info/data), requested
+    through the same rate limiter + retries as the sequence batches.
+    Raises FetchError if it cannot be had."""
+    try:
+        response = requestWithRetries('GET', f"{server}/info/data", limiter, retries, backoff, 30, metrics)
+        response.raise_for_status()
+        return str(max(response.json()['releases']))
+    except (requests.RequestException, KeyError, ValueError) as e:
+        raise FetchError(f"{type(e).__name__}: {e}")
+
+
+def writeFastaFile(filename, header, seq):
+    """Write a single record FASTA file. The file is written under a
+    temporary name first so an interrupted run never leaves a
+    partial file that a later run would skip."""
+    tmpFilename = filename.with_name(f"{filename.name}.tmp")
+    with open(tmpFilename, 'w') as oh:
+        oh.write(f">{header}\n")
+        oh.write(wrapSequence(seq, 80))
+    os.replace(tmpFilename, filename)
+    return
+
+
+########################## Offline Backend ##########################
+"""
+Offline lookups against local Ensembl FASTA dumps, e.g.
+    Felis_catus.Felis_catus_9.0.cdna.all.fa.gz
+    Felis_catus.Felis_catus_9.0.pep.all.fa.gz
+Ensembl headers look like
+    >ENSFCAP00000000001.3 pep primary_assembly:Felis_catus_9.0:A1:1:100:1 gene:ENSFCAG00000000001.4 ...
+ProteinIDs are looked up by record name. The dumps have no genomic gene
+sequence, so a GeneID resolves to the longest cDNA/ncRNA transcript of
+that gene.
+"""
+FASTA_SUFFIXES = ('.fa', '.fasta', '.fa.gz', '.fasta.gz', '.fa.bgz', '.fasta.bgz')
+
+
+def expandFastaPaths(paths):
+    """FASTA files given directly or found in the given directories"""
+    fastaPaths = []
+    for path in [Path(p) for p in paths]:
+        if path.is_dir():
+            fastaPaths.extend(sorted(f for f in path.iterdir() if f.name.endswith(FASTA_SUFFIXES)))
+        else:
+            fastaPaths.append(path)
+        continue
+    return fastaPaths
+
+
+def unversioned(stableID):
+    return stableID.split('.')[0]
+
+
+class EnsemblFastaBackend:
+    """GeneID + ProteinID lookups in indexed local Ensembl FASTA dumps"""
+    def __init__(self, paths):
+        self.indexes = [FastaIndex(p) for p in expandFastaPaths(paths)]
+        self.records = {}
+        self.transcripts = {}
+        for index in self.indexes:
+            for name, header in index.headers.items():
+                fields = header.split(' ')
+                molecule = fields[1] if len(fields) > 1 else ''
+                location = fields[2] if len(fields) > 2 else ''
+                self.records[unversioned(name)] = (index, name, molecule, location)
+                geneIDs = [f[5:] for f in fields[3:] if f.startswith('gene:')]
+                if geneIDs and (molecule in ('cdna', 'ncrna')):
+                    self.transcripts.setdefault(unversioned(geneIDs[0]), []).append((index.records[name][0], unversioned(name)))
+                continue
+            continue
+        return
+
+    def lookup(self, stableID):
+        """Return a /sequence/id style result for stableID, or None"""
+        recordID = unversioned(stableID)
+        if (recordID not in self.records) and (recordID in self.transcripts):
+            # Longest transcript of the gene
+            recordID = max(self.transcripts[recordID])[1]
+        if recordID not in self.records:
+            return None
+        index, name, molecule, location = self.records[recordID]
+        return {'id': name, 'query': stableID, 'seq': index.fetch(name), 'desc': location, 'molecule': molecule}
+
+    def fetchSequences(self, ids):
+        """Same return value as fetchSequences() -- nothing can fail
+        offline other than an ID not being present"""
+        results = {}
+        for stableID in dict.fromkeys(ids):
+            result = self.lookup(stableID)
+            if result is not None:
+                results[stableID] = result
+            continue
+        return results, {}
+
+    def close(self):
+        for index in self.indexes:
+            index.close()
+        return
+
+
+########################## Run Logs ##########################
+class JsonlRunLog:
+    """One JSON object per record in a single log file per run"""
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.fh = open(path, 'w', buffering=1 << 16)
+        self.counts = {}
+        return
+
+    def record(self, **fields):
+        self.counts[fields['status']] = self.counts.get(fields['status'], 0) + 1
+        self.fh.write(json.dumps(fields) + '\n')
+        return
+
+    def close(self):
+        self.fh.close()
+        return
+
+
+def setupTextLogger(logFile):
+    """Logger writing plain text records to logFile + the terminal"""
+    formatter = logging.Formatter('%(message)s')
+    logger = logging.getLogger(logFile.as_posix())
+    logger.setLevel(logging.INFO)
+    stream_handler = logging.StreamHandler()
+    file_handler = logging.FileHandler(logFile)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    logger.addHandler(stream_handler)
+    return logger
+
 
 ########################### Main Function ###########################
 def main():
@@ -44,93 +415,247 @@ def main():
         # default='./ensembl_sequences',
         help='',
     )
+    parser.add_argument(
+        '--server',
+        type=str,
+        action='store',
+        default=ENSEMBL_REST_SERVER,
+        help=f'Ensembl REST server to fetch from [default: {ENSEMBL_REST_SERVER}]',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        action='store',
+        default=ENSEMBL_MAX_POST_IDS,
+        help=f'Number of IDs sent per /sequence/id request [max: {ENSEMBL_MAX_POST_IDS}]',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        action='store',
+        default=4,
+        help='Number of concurrent requests',
+    )
+    parser.add_argument(
+        '--rate',
+        type=float,
+        action='store',
+        default=ENSEMBL_REQUESTS_PER_SECOND,
+        help=f'Maximum requests per second [default: {ENSEMBL_REQUESTS_PER_SECOND}, the Ensembl limit]',
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        action='store',
+        default=5,
+        help='Number of retries for rate limited (429), server error (5xx) and connection failures',
+    )
+    parser.add_argument(
+        '--release',
+        type=str,
+        action='store',
+        default=None,
+        help='Ensembl release the sequences are cached under [default: asked from the server]',
+    )
+    parser.add_argument(
+        '--cache',
+        type=str,
+        action='store',
+        default=DEFAULT_CACHE.as_posix(),
+        help=f'Sequence cache file [default: {DEFAULT_CACHE}]',
+    )
+    parser.add_argument(
+        '--cache-size-mb',
+        type=float,
+        action='store',
+        default=2048,
+        help='Size cap of the sequence cache, least recently used sequences are evicted past it',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not read from or write to the sequence cache',
+    )
+    parser.add_argument(
+        '--overwrite',
+        action='store_true',
+        help='Clear old logs and refetch sequences that were already written by an earlier run',
+    )
+    parser.add_argument(
+        '--fasta',
+        type=str,
+        action='store',
+        nargs='+',
+        default=None,
+        help='Local Ensembl cDNA/peptide FASTA dumps (plain or bgzip, files or directories) -- reads sequences offline instead of using the REST API',
+    )
+    parser.add_argument(
+        '--output-mode',
+        type=str,
+        action='store',
+        choices=['per-record', 'consolidated'],
+        default='per-record',
+        help='per-record: one FASTA file per ID [default], consolidated: one indexed multi-FASTA per ID type',
+    )
+    parser.add_argument(
+        '--log-format',
+        type=str,
+        action='store',
+        choices=['text', 'jsonl'],
+        default=None,
+        help='text: gene/protein log files [per-record default], jsonl: one structured log per run [consolidated default]',
+    )
+    addMetricsArguments(parser)
     args = parser.parse_args()
+    profiler = startProfile(args.profile)
+    metrics = makeMetrics(args.metrics)
     
     # --- Input Argparse Variables ---
     INPUT= Path(args.input)
     GENE = str(args.gene)
     OUTPUT= Path(args.output)
+    SERVER = args.server.rstrip('/')
+    BATCH_SIZE = min(max(1, args.batch_size), ENSEMBL_MAX_POST_IDS)
+    THREADS = args.threads
+    RATE = args.rate
+    RETRIES = args.retries
+    OVERWRITE = args.overwrite
+    OUTPUT_MODE = args.output_mode
+    LOG_FORMAT = args.log_format or ('jsonl' if OUTPUT_MODE == 'consolidated' else 'text')
     print(GENE, OUTPUT)
-    GENE_OUTPUT = OUTPUT / 'GeneID' / GENE
-    PROTEIN_OUTPUT = OUTPUT / 'ProteinID' / GENE
-    GENE_LOG_OUTPUT = OUTPUT / 'gene_logs/'
-    PROTEIN_LOG_OUTPUT = OUTPUT / 'protein_logs/'
-    GENE_LOG_OUTPUT_FILE = GENE_LOG_OUTPUT / f'{GENE}_fetchEnsemblSequences_GeneID.log'
-    PROTEIN_LOG_OUTPUT_FILE = PROTEIN_LOG_OUTPUT / f'{GENE}_fetchEnsemblSequences_ProteinID.log'
-
-    # Clear log file if it exist
-    if os.path.exists(GENE_LOG_OUTPUT_FILE):
-        os.remove(GENE_LOG_OUTPUT_FILE)
-    if os.path.exists(PROTEIN_LOG_OUTPUT_FILE):
-        os.remove(PROTEIN_LOG_OUTPUT_FILE)
-
-    # Make output directory
-    GENE_OUTPUT.mkdir(parents=True, exist_ok=True)
-    GENE_LOG_OUTPUT.mkdir(parents=True, exist_ok=True)
-    PROTEIN_OUTPUT.mkdir(parents=True, exist_ok=True)
-    PROTEIN_LOG_OUTPUT.mkdir(parents=True, exist_ok=True)
-
-    # Set up logging output files + handlers + streams
-    formatter = logging.Formatter('%(message)s')
-    # Gene logging
-    gene_logger = logging.getLogger(GENE_LOG_OUTPUT_FILE.as_posix())
-    gene_logger.setLevel(logging.INFO)
-    gene_stream_handler = logging.StreamHandler()
-    gene_file_handler = logging.FileHandler(GENE_LOG_OUTPUT_FILE)
-    gene_file_handler.setFormatter(formatter)
-    gene_logger.addHandler(gene_file_handler)
-    gene_logger.addHandler(gene_stream_handler)
-    # Protein logging
-    protein_logger = logging.getLogger(PROTEIN_LOG_OUTPUT_FILE.as_posix())
-    protein_logger.setLevel(logging.INFO)
-    protein_stream_handler = logging.StreamHandler()
-    protein_file_handler = logging.FileHandler(PROTEIN_LOG_OUTPUT_FILE)
-    protein_file_handler.setFormatter(formatter)
-    protein_logger.addHandler(protein_file_handler)
-    protein_logger.addHandler(protein_stream_handler)
 
     # Load input file into df + fill na values with str(NULL)
     df = pd.read_csv(INPUT, sep='\t')
     df = df.fillna('NULL')
-    # Fetch information + output + log
+    records = []
     for row in df.itertuples(index=False):
         if 'NULL' in row.Gene:
             geneName = 'NULL_Novel'
         else:
             geneName = row.Gene
-        # Row attributes
+        # Row attributes + FASTA headers
         commonName = row.CommonName
         sampleOrder = row.Order
-        geneID = row.GeneID
-        proteinID = row.ProteinID
-        # Output filenames
-        geneOutputFileName = GENE_OUTPUT / f"{geneName}_{commonName}_{sampleOrder}_{geneID}.fasta"
-        proteinOutputFileName = PROTEIN_OUTPUT / f"{geneName}_{commonName}_{sampleOrder}_{proteinID}.fasta"
-        # Fetch gene sequences
-        try:
-            gene_fasta_results = ensembl_rest.sequence_id(geneID)
-            with open(geneOutputFileName, 'w') as oh:
-                oh.write(f">{geneOutputFileName.stem}\n")
-                oh.write(textwrap.fill(gene_fasta_results['seq'], width=80))
-            gene_logger.info('----------------------------------------------------------------')
-            gene_logger.info(f"CommonName: {commonName}\nGeneID: {geneID}\nSeqFile: {geneOutputFileName}\nDescription: {gene_fasta_results['desc']}")
-        except:
-            gene_logger.info('----------------------------------------------------------------')
-            gene_logger.info(f'Could not find info for {geneID}')
-            pass
-        # Fetch protein sequences
+        records.append((commonName, 'GeneID', str(row.GeneID), f"{geneName}_{commonName}_{sampleOrder}_{row.GeneID}"))
+        records.append((commonName, 'ProteinID', str(row.ProteinID), f"{geneName}_{commonName}_{sampleOrder}_{row.ProteinID}"))
+        continue
+
+    # Set up the FASTA outputs -- ID type -> output directory or multi-FASTA writer
+    if OUTPUT_MODE == 'consolidated':
+        outputs = {}
+        for idType in ('GeneID', 'ProteinID'):
+            (OUTPUT / idType).mkdir(parents=True, exist_ok=True)
+            outputs[idType] = MultiFastaWriter(OUTPUT / idType / f"{GENE}.fasta", overwrite=OVERWRITE)
+            continue
+        seqFile = lambda idType, header: outputs[idType].path
+        alreadyWritten = lambda idType, header: header in outputs[idType]
+    else:
+        outputs = {'GeneID': OUTPUT / 'GeneID' / GENE, 'ProteinID': OUTPUT / 'ProteinID' / GENE}
+        for outputDir in outputs.values():
+            outputDir.mkdir(parents=True, exist_ok=True)
+            continue
+        seqFile = lambda idType, header: outputs[idType] / f"{header}.fasta"
+        alreadyWritten = lambda idType, header: seqFile(idType, header).exists()
+
+    # Set up logging
+    if LOG_FORMAT == 'jsonl':
+        runStamp = time.strftime('%Y%m%d-%H%M%S')
+        runLog = JsonlRunLog(OUTPUT / 'logs' / f'{GENE}_fetchEnsemblSequences_{runStamp}.jsonl')
+    else:
+        loggers = {}
+        for idType, logDir in (('GeneID', 'gene_logs'), ('ProteinID', 'protein_logs')):
+            logFile = OUTPUT / logDir / f'{GENE}_fetchEnsemblSequences_{idType}.log'
+            logFile.parent.mkdir(parents=True, exist_ok=True)
+            # Logs are appended to so an interrupted run can be resumed,
+            # clear them only when starting over
+            if OVERWRITE and logFile.exists():
+                os.remove(logFile)
+            loggers[idType] = setupTextLogger(logFile)
+            continue
+
+    # Skip sequences already written by an earlier run
+    if not OVERWRITE:
+        records = [r for r in records if not alreadyWritten(r[1], r[3])]
+    idsToFetch = [r[2] for r in records]
+
+    # Serve what we can from the cache, then fetch the rest
+    fasta_lookup, fetch_failures = {}, {}
+    offline = None if args.fasta is None else EnsemblFastaBackend(args.fasta)
+    cache = None if (args.no_cache or offline) else SequenceCache(args.cache, int(args.cache_size_mb * 1024 * 1024))
+    limiter = TokenBucket(RATE)
+    if cache is not None:
         try:
-            protein_fasta_results = ensembl_rest.sequence_id(proteinID)
-            with open(proteinOutputFileName, 'w') as oh:
-                oh.write(f">{proteinOutputFileName.stem}\n")
-                oh.write(textwrap.fill(protein_fasta_results['seq'], width=80))
-            protein_logger.info('----------------------------------------------------------------')
-            protein_logger.info(f"CommonName: {commonName}\nProteinID: {proteinID}\nSeqFile: {proteinOutputFileName}\nDescription: {protein_fasta_results['desc']}")
-        except:
-            protein_logger.info('----------------------------------------------------------------')
-            protein_logger.info(f'Could not find info for {proteinID}')
-            pass
+            release = args.release or ensemblRelease(SERVER, limiter, RETRIES, metrics=metrics)
+        except FetchError as e:
+            cache.close()
+            sys.exit(f"Could not get the Ensembl release from {SERVER} ({e}) -- pass it with --release, or use --no-cache")
+        with metrics.stage('cache_lookup'):
+            fasta_lookup = cache.get(idsToFetch, release)
+    missingIDs = [i for i in idsToFetch if i not in fasta_lookup]
+    print(f"{len(records):,} sequences to write -- {len(fasta_lookup):,} cached, {len(dict.fromkeys(missingIDs)):,} to fetch")
+    if missingIDs and offline:
+        with metrics.stage('offline_lookup'):
+            fasta_lookup, fetch_failures = offline.fetchSequences(missingIDs)
+    elif missingIDs:
+        # Each batch goes into the cache as soon as it arrives, so
+        # a crash part way through does not lose what was fetched
+        def cacheBatch(results):
+            with metrics.stage('cache_write'):
+                cache.put(results, release)
+            return
+        with metrics.stage('fetch'):
+            fetched, fetch_failures = fetchSequences(missingIDs, SERVER, BATCH_SIZE, THREADS, RATE, RETRIES, onResults=None if cache is None else cacheBatch, metrics=metrics, limiter=limiter)
+        fasta_lookup.update(fetched)
+    if cache is not None:
+        cache.close()
+    if offline is not None:
+        offline.close()
+
+    # Output + log
+    for commonName, idType, stableID, header in records:
+        if stableID in fetch_failures:
+            status, fasta_results = 'failed', None
+        elif stableID not in fasta_lookup:
+            status, fasta_results = 'not_found', None
+        else:
+            status, fasta_results = 'written', fasta_lookup[stableID]
+            with metrics.stage('write'):
+                if OUTPUT_MODE == 'consolidated':
+                    outputs[idType].write(header, fasta_results['seq'])
+                else:
+                    writeFastaFile(seqFile(idType, header), header, fasta_results['seq'])
+        metrics.add(f'records_{status}')
+        with metrics.stage('log'):
+            if LOG_FORMAT == 'jsonl':
+                runLog.record(
+                    gene=GENE, common_name=commonName, id_type=idType, id=stableID, status=status,
+                    seq_file=seqFile(idType, header).as_posix() if fasta_results else None,
+                    header=header if fasta_results else None,
+                    length=len(fasta_results['seq']) if fasta_results else None,
+                    description=fasta_results['desc'] if fasta_results else None,
+                    error=fetch_failures.get(stableID),
+                )
+                continue
+            logger = loggers[idType]
+            logger.info('----------------------------------------------------------------')
+            if status == 'failed':
+                logger.info(f'Failed to fetch info for {stableID} -- {fetch_failures[stableID]}')
+            elif status == 'not_found':
+                logger.info(f'Could not find info for {stableID}')
+            else:
+                logger.info(f"CommonName: {commonName}\n{idType}: {stableID}\nSeqFile: {seqFile(idType, header)}\nDescription: {fasta_results['desc']}")
         continue
+    if OUTPUT_MODE == 'consolidated':
+        with metrics.stage('write'):
+            for writer in outputs.values():
+                writer.close()
+    if LOG_FORMAT == 'jsonl':
+        runLog.close()
+        print(f"{runLog.counts} -- log written to {runLog.path}")
+    stopProfile(profiler, args.profile)
+    if metrics:
+        metrics.write(args.metrics, script='fetchEnsemblSequences.py', gene=GENE, server=SERVER, threads=THREADS)
+        print(f"Stage metrics written to {args.metrics}")
     return
 
 if __name__ == "__main__":
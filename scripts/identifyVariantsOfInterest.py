@@ -1,7 +1,19 @@
 import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+import glob
+import hashlib
+import json
+import os
 from pathlib import Path
-from Bio import AlignIO
-import pandas as pd
+import time
+import numpy as np
+from alignmentMatrix import columnWindows, loadAlignmentMatrix
+from cladeContrasts import CONTRAST_COLUMNS, compileContrasts, findCladeSubstitutions, parseContrasts, readGroupTable
+from fastaIndex import fileStats, indexIsCurrent
+from resultWriters import TsvResultWriter, WRITER_FORMATS, openResultWriter, outputFormat
+from stageMetrics import NULL_METRICS, addMetricsArguments, makeMetrics, startProfile, stopProfile
 """
 This script will take in multi-alginment fasta file and will locate positions 
 where a single sample has a change in comparison to all other samples. 
@@ -12,6 +24,282 @@ If the script identifies the unique amino acid to be "-" it will ignore it
 The user will ultimately need to prune the output dataframe to remove hits for 
 non-species of interst. (primates for our case)
 """
+GAP = ord('-')
+RESULT_COLUMNS = ['seqName', 'position', 'uniqueAA', 'allSampleBases']
+ALIGNMENT_SUFFIXES = ('.fasta', '.fa', '.fas', '.faa', '.aln', '.afa')
+INTEGER_COLUMNS = ['position', 'foregroundSamples', 'backgroundSamples']
+
+# Scan rules shared by single file + batch mode. contrasts/groupTable are
+# only set for clade contrast scans.
+ScanSettings = namedtuple('ScanSettings', ['maxGapFraction', 'maxStates', 'exclude', 'groupTable', 'contrasts'])
+DEFAULT_SETTINGS = ScanSettings(0.5, 2, ('primate',), None, None)
+
+
+def excludedRows(names, exclude):
+    """Boolean mask of the samples whose name contains any exclude substring"""
+    return np.array([any(e in name for e in exclude) for name in names], dtype=bool)
+
+
+def findUniqueVariants(names, matrix, columnOffset=0, maxGapFraction=0.5, maxStates=2, excluded=None):
+    """Return [seqName, position, uniqueAA, allSampleBases] for every column where
+    one sample carries a residue no other sample has. All filters are computed
+    for every column at once:
+        1. >maxGapFraction gaps -> skipped
+        2. >maxStates different residues (gaps count) -> skipped
+        3. the unique residue is a gap, or the sample is excluded -> skipped
+    When more than one sample is unique (two sample columns, or any column once
+    maxStates > 2) the first row wins.
+    excluded defaults to the samples with 'primate' in their name."""
+    if excluded is None:
+        excluded = excludedRows(names, DEFAULT_SETTINGS.exclude)
+    nSamples = matrix.shape[0]
+    gapFraction = (matrix == GAP).sum(axis=0) / nSamples
+    ordered = np.sort(matrix, axis=0)
+    changes = ordered[1:] != ordered[:-1]
+    states = 1 + changes.sum(axis=0)
+    candidates = np.flatnonzero((gapFraction <= maxGapFraction) & (states <= maxStates))
+    if len(candidates) == 0:
+        return []
+    # With at most two residues per column, a residue's count is either
+    # the count of the column's lowest residue or the remainder
+    sub = matrix[:, candidates]
+    isLowest = sub == ordered[0, candidates]
+    lowestCount = isLowest.sum(axis=0)
+    singletons = np.where(isLowest, lowestCount, nSamples - lowestCount) == 1
+    # Columns with more residues (maxStates > 2): in the sorted column a
+    # residue seen once differs from both of its neighbours
+    manyStates = np.flatnonzero(states[candidates] > 2)
+    if len(manyStates):
+        wide = candidates[manyStates]
+        order = np.argsort(matrix[:, wide], axis=0, kind='stable')
+        edges = np.ones((nSamples + 1, len(wide)), dtype=bool)
+        edges[1:-1] = changes[:, wide]
+        unique = np.zeros((nSamples, len(wide)), dtype=bool)
+        np.put_along_axis(unique, order, edges[:-1] & edges[1:], axis=0)
+        singletons[:, manyStates] = unique
+    hasSingleton = singletons.any(axis=0)
+    rows = singletons.argmax(axis=0)[hasSingleton]
+    cols = candidates[hasSingleton]
+    residues = matrix[rows, cols]
+    keep = (residues != GAP) & ~excluded[rows]
+    results = []
+    for row, col, residue in zip(rows[keep], cols[keep], residues[keep]):
+        results.append([names[row], int(col) + columnOffset, chr(residue), matrix[:, col].tobytes().decode()])
+        continue
+    return results
+
+
+def resultColumns(settings):
+    return RESULT_COLUMNS if settings.contrasts is None else CONTRAST_COLUMNS
+
+
+def iterAlignmentHits(alignmentPath, window, cacheDir=None, settings=DEFAULT_SETTINGS, metrics=NULL_METRICS):
+    """Scan one alignment file a window of columns at a time, yielding the
+    hits of each window as soon as it is done. Sample masks (excluded
+    samples or clade contrasts) are compiled once per alignment."""
+    with metrics.stage('load_matrix'):
+        names, matrix = loadAlignmentMatrix(alignmentPath, cacheDir, metrics)
+    with metrics.stage('compile_masks'):
+        if settings.contrasts is None:
+            excluded = excludedRows(names, settings.exclude)
+        else:
+            contrasts = compileContrasts(names, settings.groupTable, settings.contrasts)
+    metrics.add('alignments')
+    metrics.add('samples', matrix.shape[0])
+    for start, columns in columnWindows(matrix, window):
+        with metrics.stage('scan'):
+            if settings.contrasts is None:
+                hits = findUniqueVariants(names, columns, start, settings.maxGapFraction, settings.maxStates, excluded)
+            else:
+                hits = findCladeSubstitutions(columns, contrasts, start, settings.maxGapFraction, settings.maxStates)
+        metrics.add('columns', columns.shape[1])
+        metrics.add('hits', len(hits))
+        yield hits
+        continue
+    return
+
+
+def printHits(hits, settings):
+    for hit in hits:
+        if settings.contrasts is None:
+            print(f"Unique AA found! -- PositionInAlinment:{hit[1]} -- ChangedAminoAcid: {hit[2]} -- SampleName:{hit[0]}")
+        else:
+            print(f"Lineage specific substitution found! -- Contrast:{hit[0]} -- PositionInAlinment:{hit[1]} -- ForegroundAminoAcid: {hit[2]} -- BackgroundAminoAcids: {hit[3]}")
+        continue
+    return
+
+
+def dropSampleBases(hits):
+    """allSampleBases is the last column of both result layouts"""
+    return [hit[:-1] for hit in hits]
+
+
+########################## Batch Mode ##########################
+def isAlignmentFile(path):
+    name = path.name[:-3] if path.name.endswith('.gz') else path.name
+    return name.endswith(ALIGNMENT_SUFFIXES)
+
+
+def alignmentName(path):
+    """Alignment file name without its alignment (+ .gz) suffixes"""
+    name = path.name[:-3] if path.name.endswith('.gz') else path.name
+    for suffix in ALIGNMENT_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def expandAlignmentPaths(pattern):
+    """Alignment files of a directory or glob pattern, in sorted order"""
+    if Path(pattern).is_dir():
+        paths = [p for p in Path(pattern).iterdir() if isAlignmentFile(p)]
+    else:
+        paths = [Path(p) for p in glob.glob(pattern)]
+    # Skip the cached matrices written next to the alignments
+    return sorted(p for p in paths if p.is_file() and not p.name.endswith(('.matrix.npy', '.names.txt', '.source.json')))
+
+
+def isBatchInput(pattern):
+    return Path(pattern).is_dir() or glob.has_magic(pattern)
+
+
+def scanAlignmentPart(alignmentPath, partPath, window, cacheDir, settings, collectMetrics=False):
+    """Worker -- scan one alignment, stream its results to partPath and
+    return (number of results, seconds taken, stage metrics snapshot).
+    The alignment's path, size + mtime at the start of the scan are
+    written to the part's source file last."""
+    start = time.perf_counter()
+    metrics = makeMetrics(collectMetrics)
+    sourcePath = partSourcePath(partPath)
+    if sourcePath.exists():
+        os.remove(sourcePath)
+    stats = fileStats(alignmentPath)
+    tmpPath = partPath.with_name(f"{partPath.name}.tmp")
+    with TsvResultWriter(tmpPath, resultColumns(settings)) as writer:
+        for hits in iterAlignmentHits(alignmentPath, window, cacheDir, settings, metrics):
+            with metrics.stage('write_part'):
+                writer.write(hits)
+            continue
+    os.replace(tmpPath, partPath)
+    sourcePath.write_text(json.dumps(stats))
+    return writer.rows, time.perf_counter() - start, metrics.snapshot()
+
+
+def partSourcePath(partPath):
+    return Path(f"{partPath}.source.json")
+
+
+def iterResultPart(partPath, chunkRows=50000):
+    """Yield the rows of a part file in chunks, integer columns converted"""
+    with open(partPath, newline='') as fh:
+        reader = csv.reader(fh, delimiter='\t')
+        header = next(reader)
+        integers = [n for n, c in enumerate(header) if c in INTEGER_COLUMNS]
+        chunk = []
+        for row in reader:
+            for n in integers:
+                row[n] = int(row[n])
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunkRows:
+                yield chunk
+                chunk = []
+            continue
+        if chunk:
+            yield chunk
+    return
+
+
+def settingsKey(settings):
+    """Short fingerprint of the scan settings -- results of other settings are not reused"""
+    return hashlib.sha1(repr(settings).encode()).hexdigest()[:10]
+
+
+def resultPartPaths(alignments, PARTS, settings):
+    """Part file of each alignment, laid out under PARTS as the alignments
+    are under their common directory so dir/*/ACTB.fasta do not collide"""
+    resolved = {a: a.resolve() for a in alignments}
+    root = Path(os.path.commonpath([r.parent for r in resolved.values()]))
+    key = settingsKey(settings)
+    partPaths = {}
+    for alignment, path in resolved.items():
+        relative = path.relative_to(root)
+        partPaths[alignment] = PARTS / relative.parent / f"{relative.name}.{key}.tsv"
+        partPaths[alignment].parent.mkdir(parents=True, exist_ok=True)
+        continue
+    return partPaths
+
+
+def batchMain(pattern, OUTPUT, WINDOW, CACHE_DIR, WORKERS, settings=DEFAULT_SETTINGS, FORMAT=None, SAMPLE_BASES=True, VERBOSE=False, metrics=NULL_METRICS):
+    """Scan every alignment of a directory/glob across a process pool and
+    write one combined table with a gene column. Per alignment results are
+    kept in <output>_parts/ and reused until the alignment's path, size
+    or mtime change."""
+    alignments = expandAlignmentPaths(pattern)
+    if not alignments:
+        raise SystemExit(f"No alignments found for {pattern}")
+    if OUTPUT.suffix.lower() not in WRITER_FORMATS:
+        OUTPUT = OUTPUT / f"variantsOfInterest.{FORMAT or 'tsv'}"
+    FORMAT = FORMAT or outputFormat(OUTPUT)
+    OUTPUT.parent.mkdir(parents=True, exist_ok=True)
+    PARTS = OUTPUT.parent / f"{OUTPUT.stem}_parts"
+    partPaths = resultPartPaths(alignments, PARTS, settings)
+
+    timings = {}
+    toScan = []
+    for alignment in alignments:
+        partPath = partPaths[alignment]
+        if indexIsCurrent(alignment, partSourcePath(partPath), [partPath]):
+            timings[alignment] = ('current', 0.0)
+        else:
+            toScan.append(alignment)
+        continue
+    print(f"{len(alignments):,} alignments -- {len(alignments) - len(toScan):,} current, {len(toScan):,} to scan")
+
+    batchStart = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+        futures = {pool.submit(scanAlignmentPart, a, partPaths[a], WINDOW, CACHE_DIR, settings, bool(metrics)): a for a in toScan}
+        for future in as_completed(futures):
+            alignment = futures[future]
+            count, seconds, workerMetrics = future.result()
+            metrics.merge(workerMetrics)
+            metrics.observe('alignment_seconds', round(seconds, 4))
+            timings[alignment] = ('scanned', seconds)
+            print(f"{alignment.as_posix()}\t{count:,} variants\t{seconds:.2f}s")
+            continue
+
+    # Combined table + per alignment timings, streamed in input order
+    columns = resultColumns(settings) if SAMPLE_BASES else resultColumns(settings)[:-1]
+    timingRows = []
+    with openResultWriter(OUTPUT, ['gene', 'alignment'] + columns, FORMAT, INTEGER_COLUMNS) as writer:
+        for alignment in alignments:
+            gene, rows = alignmentName(alignment), 0
+            for hits in metrics.timeIterator('read_part', iterResultPart(partPaths[alignment])):
+                if VERBOSE:
+                    printHits(hits, settings)
+                if not SAMPLE_BASES:
+                    hits = dropSampleBases(hits)
+                with metrics.stage('write'):
+                    writer.write([[gene, alignment.as_posix()] + hit for hit in hits])
+                rows += len(hits)
+                continue
+            status, seconds = timings[alignment]
+            timingRows.append([gene, alignment.as_posix(), status, round(seconds, 4), rows])
+            continue
+    timingFile = OUTPUT.parent / f"{OUTPUT.stem}_timings.tsv"
+    with TsvResultWriter(timingFile, ['gene', 'alignment', 'status', 'seconds', 'variants']) as timingWriter:
+        timingWriter.write(timingRows)
+    print(f"{writer.rows:,} variants from {len(alignments):,} alignments in {time.perf_counter() - batchStart:.2f}s -- written to {OUTPUT} (timings: {timingFile})")
+    return
+
+
+def finishMetrics(metrics, profiler, args, INPUT):
+    stopProfile(profiler, args.profile)
+    if metrics:
+        metrics.write(args.metrics, script='identifyVariantsOfInterest.py', input=INPUT.as_posix(), window=args.window)
+        print(f"Stage metrics written to {args.metrics}")
+    return
+
 
 def main():
     parser = argparse.ArgumentParser(description='')
@@ -21,7 +309,7 @@ def main():
         type=str,
         action='store',
         required=True,
-        help="",
+        help="Alignment fasta file, or a directory/glob of alignments for batch mode",
     )
     parser.add_argument(
         '-o',
@@ -29,46 +317,147 @@ def main():
         type=str,
         action='store',
         default='./ensemblGeneFamilyResults/',
-        help='',
+        help='Output table -- .xlsx, .tsv or .parquet (a directory in batch mode)',
     )
+    parser.add_argument(
+        '--format',
+        type=str,
+        action='store',
+        choices=sorted(set(WRITER_FORMATS.values())),
+        default=None,
+        help='Output format [default: from the output suffix, xlsx otherwise (tsv in batch mode)]',
+    )
+    parser.add_argument(
+        '--no-sample-bases',
+        action='store_true',
+        help='Leave the allSampleBases column out of the output',
+    )
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        help='Print every hit as it is found',
+    )
+    parser.add_argument(
+        '--window',
+        type=int,
+        action='store',
+        default=100000,
+        help='Number of alignment columns scanned at a time [default: 100000]',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        action='store',
+        default=None,
+        help='Directory for the cached alignment matrix [default: next to the alignment]',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        action='store',
+        default=os.cpu_count(),
+        help='Number of processes scanning alignments in batch mode (directory or glob input) [default: all CPUs]',
+    )
+    parser.add_argument(
+        '--max-gap-fraction',
+        type=float,
+        action='store',
+        default=DEFAULT_SETTINGS.maxGapFraction,
+        help='Skip positions with more than this fraction of gaps [default: 0.5]',
+    )
+    parser.add_argument(
+        '--max-states',
+        type=int,
+        action='store',
+        default=DEFAULT_SETTINGS.maxStates,
+        help='Skip positions with more than this many different residues, gaps included [default: 2]',
+    )
+    parser.add_argument(
+        '--exclude',
+        type=str,
+        action='store',
+        nargs='*',
+        default=list(DEFAULT_SETTINGS.exclude),
+        help='Ignore unique residues of samples whose name contains any of these [default: primate]',
+    )
+    parser.add_argument(
+        '--groups',
+        type=str,
+        action='store',
+        default=None,
+        help='Species -> group table (xlsx/tsv, e.g. speciesNameConverter.xlsx) for --contrast scans',
+    )
+    parser.add_argument(
+        '--group-key',
+        type=str,
+        action='store',
+        default='common_name',
+        help='--groups column matched against the sample names [default: common_name, else the first column]',
+    )
+    parser.add_argument(
+        '--group-columns',
+        type=str,
+        action='store',
+        nargs='+',
+        default=None,
+        help='--groups columns holding group names [default: all other columns]',
+    )
+    parser.add_argument(
+        '--contrast',
+        type=str,
+        action='store',
+        nargs='+',
+        default=None,
+        help='Clade contrasts to scan for lineage specific substitutions: group (vs all other samples) or group:group, e.g. carnivora primates:rodentia',
+    )
+    addMetricsArguments(parser)
     args = parser.parse_args()
+    profiler = startProfile(args.profile)
+    metrics = makeMetrics(args.metrics)
     INPUT = Path(args.input)
     OUTPUT = Path(args.output)    
+    WINDOW = max(1, args.window)
 
-    aln = AlignIO.read(open(INPUT), "fasta")
-    diff_df = pd.DataFrame(columns=['seqName', 'position', 'uniqueAA', 'allSampleBases'])
-    df_idx = 0
-    for i in range(len(aln[0].seq)):
-        pos_data = aln[:, i]
-        sample_names = [n.id for n in aln[:, i:i]]
-        if (pos_data.count("-")/len(pos_data)) > 0.5:
-            continue
-        elif len(list(set(pos_data))) > 2:
-            continue
-        else:
-            aa_to_find = [a for a in pos_data if (pos_data.count(a) == 1) and (pos_data != '-')]
-            if len(aa_to_find) == 0:
-                continue
-            aa_to_find_pos = pos_data.rindex(aa_to_find[0])
-            if pos_data[aa_to_find_pos] == '-':
-                continue
-            elif 'primate' in sample_names[aa_to_find_pos]:
-                continue
-            print(f"Unique AA found! -- PositionInAlinment:{i} -- ChangedAminoAcid: {pos_data[aa_to_find_pos]} -- SampleName:{sample_names[aa_to_find_pos]}")
-            diff_df.at[df_idx, 'seqName'] = sample_names[aa_to_find_pos]
-            diff_df.at[df_idx, 'position'] = i
-            diff_df.at[df_idx, 'uniqueAA'] = pos_data[aa_to_find_pos]
-            diff_df.at[df_idx, 'allSampleBases'] = pos_data
-            df_idx += 1
-            continue
-    if len(diff_df) == 0:
-        OUTPUT = OUTPUT.parents[0] / f"{OUTPUT.stem}_NO_RESULTS.xlsx"
+    # Clade contrasts are compiled from the group table once, up front
+    if bool(args.groups) != bool(args.contrast):
+        parser.error('--groups and --contrast must be given together')
+    groupTable, contrasts = None, None
+    if args.groups:
+        groupTable = readGroupTable(args.groups, args.group_key, args.group_columns)
+        try:
+            contrasts = tuple(parseContrasts(args.contrast, groupTable))
+        except ValueError as e:
+            parser.error(str(e))
+    settings = ScanSettings(args.max_gap_fraction, args.max_states, tuple(args.exclude), groupTable, contrasts)
+
+    SAMPLE_BASES = not args.no_sample_bases
+    VERBOSE = args.verbose
+
+    # Directory or glob input -> one combined table for all alignments
+    if isBatchInput(args.input):
+        batchMain(args.input, OUTPUT, WINDOW, args.cache_dir, max(1, args.workers), settings, args.format, SAMPLE_BASES, VERBOSE, metrics)
+        finishMetrics(metrics, profiler, args, INPUT)
+        return
 
-    print(diff_df)
-    diff_df.to_excel(OUTPUT, index=False)
+    # Memory-mapped alignment matrix, scanned a window of columns at a time
+    # with each window's hits written out as soon as it is done
+    FORMAT = args.format or outputFormat(OUTPUT)
+    columns = resultColumns(settings) if SAMPLE_BASES else resultColumns(settings)[:-1]
+    with openResultWriter(OUTPUT, columns, FORMAT, INTEGER_COLUMNS) as writer:
+        for hits in iterAlignmentHits(INPUT, WINDOW, args.cache_dir, settings, metrics):
+            if VERBOSE:
+                printHits(hits, settings)
+            with metrics.stage('write'):
+                writer.write(hits if SAMPLE_BASES else dropSampleBases(hits))
+            continue
+    if writer.rows == 0:
+        noResults = OUTPUT.parents[0] / f"{OUTPUT.stem}_NO_RESULTS{OUTPUT.suffix}"
+        os.replace(OUTPUT, noResults)
+        OUTPUT = noResults
+    print(f"{writer.rows:,} hits written to {OUTPUT}")
+    finishMetrics(metrics, profiler, args, INPUT)
     return
 
 if __name__ == '__main__':
     main()
-
-
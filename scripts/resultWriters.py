@@ -0,0 +1,135 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Streaming writers for variant scan results. Rows are written as they
+are found instead of being collected into a DataFrame first:
+    tsv      -- plain text, written row by row
+    parquet  -- pyarrow row groups of batchRows rows (pip install pyarrow)
+    xlsx     -- openpyxl write-only workbook (pip install openpyxl),
+                the slowest option and capped at 1,048,576 rows
+"""
+import csv
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+WRITER_FORMATS = {'.tsv': 'tsv', '.txt': 'tsv', '.parquet': 'parquet', '.xlsx': 'xlsx'}
+EXCEL_MAX_ROWS = 1048576
+
+
+class ResultWriter:
+    """Base class -- subclasses implement writeRows() + close()"""
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        return
+
+    def write(self, rows):
+        if not rows:
+            return
+        self.writeRows(rows)
+        self.rows += len(rows)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class TsvResultWriter(ResultWriter):
+    def __init__(self, path, columns):
+        super().__init__(path, columns)
+        self.fh = open(path, 'w', newline='', buffering=1 << 20)
+        self.writer = csv.writer(self.fh, delimiter='\t', lineterminator='\n')
+        self.writer.writerow(self.columns)
+        return
+
+    def writeRows(self, rows):
+        self.writer.writerows(rows)
+        return
+
+    def close(self):
+        self.fh.close()
+        return
+
+
+class ParquetResultWriter(ResultWriter):
+    def __init__(self, path, columns, integerColumns=(), batchRows=50000):
+        super().__init__(path, columns)
+        if pa is None:
+            raise ImportError("pyarrow is required for parquet output (pip install pyarrow)")
+        self.schema = pa.schema([(c, pa.int64() if c in integerColumns else pa.string()) for c in self.columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batchRows = batchRows
+        self.buffer = []
+        return
+
+    def writeRows(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batchRows:
+            self.flush()
+        return
+
+    def flush(self):
+        if not self.buffer:
+            return
+        arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*self.buffer), self.schema)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.buffer = []
+        return
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        return
+
+
+class ExcelResultWriter(ResultWriter):
+    def __init__(self, path, columns):
+        super().__init__(path, columns)
+        if Workbook is None:
+            raise ImportError("openpyxl is required for xlsx output (pip install openpyxl)")
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+        self.sheet.append(self.columns)
+        return
+
+    def writeRows(self, rows):
+        if self.rows + len(rows) >= EXCEL_MAX_ROWS:
+            raise ValueError(f"More than {EXCEL_MAX_ROWS - 1:,} results do not fit in an xlsx sheet -- write tsv or parquet output instead")
+        for row in rows:
+            self.sheet.append(row)
+            continue
+        return
+
+    def close(self):
+        self.workbook.save(self.path)
+        return
+
+
+def outputFormat(path, default='xlsx'):
+    """Writer format of an output path from its suffix"""
+    return WRITER_FORMATS.get(path.suffix.lower(), default)
+
+
+def openResultWriter(path, columns, fmt, integerColumns=()):
+    if fmt == 'tsv':
+        return TsvResultWriter(path, columns)
+    elif fmt == 'parquet':
+        return ParquetResultWriter(path, columns, integerColumns)
+    elif fmt == 'xlsx':
+        return ExcelResultWriter(path, columns)
+    raise ValueError(f"Unknown output format '{fmt}' -- choose from {sorted(set(WRITER_FORMATS.values()))}")
@@ -0,0 +1,523 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Incremental driver for the whole workflow. Each existing script is run
+as a stage:
+
+    index   ensemblGeneFamilyHomologyFileParser.py index (once per emf file)
+    parse   ensemblGeneFamilyHomologyFileParser.py -> species count TSV per gene
+    fetch   fetchEnsemblSequences.py --output-mode consolidated
+    align   external aligner command, e.g. "mafft --auto {input} > {output}"
+    scan    identifyVariantsOfInterest.py
+
+Every stage run is fingerprinted (script versions, parameters, input
+files and the outputs of the stage before it) and recorded under
+<work>/.pipeline/. A stage is skipped while its fingerprint and outputs
+are unchanged, so adding one gene to the gene list only parses, fetches,
+aligns and scans that gene. Stale genes are parsed together in one pass
+over the emf file (through the family index when the file is not
+compressed), then fetch -> align -> scan run for --jobs genes at a time.
+
+Work directory layout:
+    family_index.sqlite
+    parse/<gene>/           parser output for the gene
+    sequences/              fetcher output (ProteinID/<gene>.fasta, ...)
+    alignments/<gene>.fasta
+    variants/<gene>.tsv
+    logs/                   stdout + stderr of every stage run
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from fastaIndex import isGzipFile
+
+SCRIPTS = Path(__file__).resolve().parent
+PARSER = SCRIPTS / 'ensemblGeneFamilyHomologyFileParser.py'
+FETCHER = SCRIPTS / 'fetchEnsemblSequences.py'
+SCANNER = SCRIPTS / 'identifyVariantsOfInterest.py'
+# Code each stage's output depends on -- editing any of it reruns the stage
+STAGE_CODE = {
+    'index': [PARSER],
+    'parse': [PARSER],
+    'fetch': [FETCHER, SCRIPTS / 'fastaIndex.py'],
+    'scan': [SCANNER, SCRIPTS / 'alignmentMatrix.py', SCRIPTS / 'cladeContrasts.py', SCRIPTS / 'resultWriters.py', SCRIPTS / 'fastaIndex.py'],
+}
+STAGES = ['index', 'parse', 'fetch', 'align', 'scan']
+ENSEMBL_REQUESTS_PER_SECOND = 15
+
+
+class StageFailed(Exception):
+    pass
+
+
+########################## Fingerprints ##########################
+def fileDigest(path, blockSize=1 << 20):
+    """sha1 of a file's content, None if it does not exist"""
+    path = Path(path)
+    if not path.is_file():
+        return None
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blockSize), b''):
+            digest.update(block)
+            continue
+    return digest.hexdigest()
+
+
+def fileStamp(path):
+    """Size + modification time -- used for inputs too large to hash on every run"""
+    stats = os.stat(path)
+    return f"{stats.st_size}:{stats.st_mtime_ns}"
+
+
+def treeDigest(root):
+    """sha1 over the relative paths + content of every file under root"""
+    root = Path(root)
+    if not root.exists():
+        return None
+    digest = hashlib.sha1()
+    for path in sorted(p for p in root.rglob('*') if p.is_file()):
+        digest.update(f"{path.relative_to(root).as_posix()}\0{fileDigest(path)}\n".encode())
+        continue
+    return digest.hexdigest()
+
+
+def fingerprint(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def codeDigest(stage):
+    return [fileDigest(path) for path in STAGE_CODE.get(stage, [])]
+
+
+class StageState:
+    """One JSON record per (gene, stage) under <work>/.pipeline/ holding the
+    fingerprint of its last successful run and the digest of its outputs"""
+    def __init__(self, stateDir):
+        self.stateDir = Path(stateDir)
+        return
+
+    def path(self, gene, stage):
+        return self.stateDir / gene / f"{stage}.json"
+
+    def load(self, gene, stage):
+        try:
+            return json.loads(self.path(gene, stage).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def save(self, gene, stage, **record):
+        path = self.path(gene, stage)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmpPath = path.with_name(f"{path.name}.tmp")
+        tmpPath.write_text(json.dumps({'stage': stage, 'gene': gene, **record}, indent=2))
+        os.replace(tmpPath, path)
+        return
+
+    def isCurrent(self, gene, stage, stageFingerprint, outputs):
+        record = self.load(gene, stage)
+        if not record or outputs is None or not record.get('complete', True):
+            return False
+        return record['fingerprint'] == stageFingerprint and record['outputs'] == outputs
+
+
+########################## Pipeline ##########################
+class Pipeline:
+    def __init__(self, args):
+        self.work = Path(args.work)
+        self.emf = Path(args.input)
+        self.species = Path(args.species) if args.species else None
+        self.aligner = args.aligner
+        self.jobs = max(1, args.jobs)
+        self.parserArgs = shlex.split(args.parser_args)
+        self.fetchArgs = shlex.split(args.fetch_args)
+        self.scanArgs = shlex.split(args.scan_args)
+        self.scanFormat = args.scan_format
+        self.force = set(args.force)
+        self.dryRun = args.dry_run
+        # Concurrent fetchers share the Ensembl request limit
+        if '--rate' not in self.fetchArgs:
+            self.fetchArgs += ['--rate', str(args.rate / self.jobs)]
+        self.state = StageState(self.work / '.pipeline')
+        self.index = self.work / 'family_index.sqlite'
+        self.logs = self.work / 'logs'
+        return
+
+    # --- Paths ---
+    def parseDir(self, gene):
+        return self.work / 'parse' / gene
+
+    def speciesCounts(self, gene):
+        return self.parseDir(gene) / 'CumulativeSpeciesCounts.tsv'
+
+    def sequenceFile(self, gene, idType='ProteinID'):
+        return self.work / 'sequences' / idType / f"{gene}.fasta"
+
+    def alignmentFile(self, gene):
+        return self.work / 'alignments' / f"{gene}.fasta"
+
+    def variantFiles(self, gene):
+        variants = self.work / 'variants'
+        return [variants / f"{gene}.{self.scanFormat}", variants / f"{gene}_NO_RESULTS.{self.scanFormat}"]
+
+    # --- Running stages ---
+    def runCommand(self, command, logName, shell=False):
+        """Run a stage command, appending its output to logs/<logName>.log.
+        Directories are only made here, when a stage runs, so --dry-run
+        leaves the work directory untouched."""
+        self.logs.mkdir(parents=True, exist_ok=True)
+        logFile = self.logs / f"{logName}.log"
+        with open(logFile, 'a') as log:
+            log.write(f"\n##### {time.strftime('%Y-%m-%d %H:%M:%S')} {command if shell else shlex.join(command)}\n")
+            log.flush()
+            result = subprocess.run(command, shell=shell, stdout=log, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            raise StageFailed(f"exit code {result.returncode} -- see {logFile}")
+        return
+
+    def runStage(self, gene, stage, stageFingerprint, outputDigest, run):
+        """Run stage unless its last run had the same fingerprint and its
+        outputs are untouched. run(rerun) is told whether the existing
+        outputs came from other inputs, and returns False if the stage
+        only partly succeeded so the next pipeline run picks it up again.
+        Returns (status, output digest)."""
+        outputs = outputDigest()
+        if stage not in self.force and self.state.isCurrent(gene, stage, stageFingerprint, outputs):
+            return 'current', outputs
+        if self.dryRun:
+            return 'stale', None
+        record = self.state.load(gene, stage)
+        start = time.perf_counter()
+        complete = run(record is not None and record['fingerprint'] != stageFingerprint) is not False
+        outputs = outputDigest()
+        self.state.save(
+            gene, stage, fingerprint=stageFingerprint, outputs=outputs, complete=complete,
+            seconds=round(time.perf_counter() - start, 3), finished=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        )
+        return ('ran' if complete else 'incomplete'), outputs
+
+    # --- index ---
+    def useIndex(self):
+        return not isGzipFile(self.emf)
+
+    def indexStage(self):
+        if not self.useIndex():
+            return 'compressed'
+        stageFingerprint = fingerprint('index', codeDigest('index'), self.emf.resolve().as_posix(), fileStamp(self.emf))
+        def run(rerun):
+            self.runCommand([sys.executable, PARSER.as_posix(), 'index', '-i', self.emf.as_posix(), '--index', self.index.as_posix()], 'index')
+            return
+        status, _ = self.runStage('_all', 'index', stageFingerprint, lambda: fileStamp(self.index) if self.index.exists() else None, run)
+        return status
+
+    # --- parse ---
+    def parseFingerprint(self, gene):
+        return fingerprint(
+            'parse', codeDigest('parse'), gene, self.parserArgs,
+            self.emf.resolve().as_posix(), fileStamp(self.emf),
+            fileDigest(self.species) if self.species else None,
+        )
+
+    def parseStage(self, genes):
+        """Parse every stale gene in a single parser run, then split the
+        output into one directory per gene. Returns {gene: (status, digest)}."""
+        results, stale = {}, []
+        for gene in genes:
+            outputs = treeDigest(self.parseDir(gene))
+            if 'parse' not in self.force and self.state.isCurrent(gene, 'parse', self.parseFingerprint(gene), outputs):
+                results[gene] = ('current', outputs)
+            else:
+                stale.append(gene)
+            continue
+        if not stale:
+            return results
+        if self.dryRun:
+            results.update({gene: ('stale', None) for gene in stale})
+            return results
+        print(f"--- Parsing {len(stale):,} genes: {', '.join(stale)} ---")
+        batchDir = self.work / 'parse' / '.batch'
+        if batchDir.exists():
+            shutil.rmtree(batchDir)
+        batchDir.mkdir(parents=True)
+        geneFile = batchDir / 'genes.txt'
+        geneFile.write_text(''.join(f"{gene}\n" for gene in stale))
+        command = [sys.executable, PARSER.as_posix(), '-i', self.emf.as_posix(), '-g', geneFile.as_posix(), '-o', (batchDir / 'out').as_posix()]
+        if self.species:
+            command += ['-s', self.species.as_posix()]
+        if self.useIndex():
+            command += ['--index', self.index.as_posix()]
+        start = time.perf_counter()
+        try:
+            self.runCommand(command + self.parserArgs, 'parse')
+        except StageFailed as e:
+            results.update({gene: ('failed', str(e)) for gene in stale})
+            return results
+        splitParserOutput(batchDir / 'out', self.work / 'parse', stale)
+        shutil.rmtree(batchDir)
+        seconds = round((time.perf_counter() - start) / len(stale), 3)
+        for gene in stale:
+            outputs = treeDigest(self.parseDir(gene))
+            self.state.save(gene, 'parse', fingerprint=self.parseFingerprint(gene), outputs=outputs, seconds=seconds, finished=time.strftime('%Y-%m-%dT%H:%M:%S'))
+            results[gene] = ('ran', outputs)
+            continue
+        return results
+
+    # --- fetch -> align -> scan ---
+    def fetchStage(self, gene, parseOutputs):
+        stageFingerprint = fingerprint('fetch', codeDigest('fetch'), gene, self.fetchArgs, parseOutputs)
+        outputDigest = lambda: fingerprint(fileDigest(self.sequenceFile(gene, 'GeneID')), fileDigest(self.sequenceFile(gene, 'ProteinID'))) if self.sequenceFile(gene).exists() else None
+        def run(rerun):
+            command = [
+                sys.executable, FETCHER.as_posix(), '-i', self.speciesCounts(gene).as_posix(), '-g', gene,
+                '-o', (self.work / 'sequences').as_posix(), '--output-mode', 'consolidated',
+            ]
+            # Sequences left by a run with other inputs are refetched, an
+            # interrupted or incomplete run resumes where it stopped
+            self.runCommand(command + self.fetchArgs + (['--overwrite'] if rerun else []), f"{gene}.fetch")
+            return failedFetches(self.work / 'sequences' / 'logs', gene) == 0
+        return self.runStage(gene, 'fetch', stageFingerprint, outputDigest, run)
+
+    def alignStage(self, gene, fetchOutputs):
+        alignment = self.alignmentFile(gene)
+        if self.aligner is None:
+            # Aligned outside of the pipeline -- picked up once it exists
+            outputs = fileDigest(alignment)
+            return ('external', outputs) if outputs else ('waiting', None)
+        stageFingerprint = fingerprint('align', self.aligner, fetchOutputs)
+        def run(rerun):
+            alignment.parent.mkdir(parents=True, exist_ok=True)
+            tmpPath = alignment.with_name(f"{alignment.name}.tmp")
+            command = self.aligner.format(input=shlex.quote(self.sequenceFile(gene).as_posix()), output=shlex.quote(tmpPath.as_posix()))
+            self.runCommand(command, f"{gene}.align", shell=True)
+            os.replace(tmpPath, alignment)
+            return
+        return self.runStage(gene, 'align', stageFingerprint, lambda: fileDigest(alignment), run)
+
+    def scanStage(self, gene, alignOutputs):
+        stageFingerprint = fingerprint('scan', codeDigest('scan'), self.scanArgs, self.scanFormat, alignOutputs)
+        outputDigest = lambda: next((fileDigest(f) for f in self.variantFiles(gene) if f.exists()), None)
+        def run(rerun):
+            for outputFile in self.variantFiles(gene):
+                if outputFile.exists():
+                    os.remove(outputFile)
+                continue
+            self.variantFiles(gene)[0].parent.mkdir(parents=True, exist_ok=True)
+            command = [
+                sys.executable, SCANNER.as_posix(), '-i', self.alignmentFile(gene).as_posix(),
+                '-o', self.variantFiles(gene)[0].as_posix(), '--cache-dir', (self.work / 'matrix_cache').as_posix(),
+            ]
+            self.runCommand(command + self.scanArgs, f"{gene}.scan")
+            return
+        return self.runStage(gene, 'scan', stageFingerprint, outputDigest, run)
+
+    def geneChain(self, gene, parseStatus, parseOutputs):
+        """fetch -> align -> scan for one gene. Returns {stage: status}."""
+        statuses = {'parse': parseStatus}
+        if parseStatus in ('failed', 'stale'):
+            return statuses
+        if countRows(self.speciesCounts(gene)) == 0:
+            statuses['fetch'] = 'no data'
+            return statuses
+        upstream = parseOutputs
+        for stage, runner in (('fetch', self.fetchStage), ('align', self.alignStage), ('scan', self.scanStage)):
+            try:
+                status, upstream = runner(gene, upstream)
+            except StageFailed as e:
+                print(f"{gene} {stage} failed: {e}")
+                statuses[stage] = 'failed'
+                return statuses
+            statuses[stage] = status
+            if status in ('stale', 'waiting', 'incomplete'):
+                break
+            continue
+        return statuses
+
+    def run(self, genes):
+        start = time.perf_counter()
+        try:
+            indexStatus = self.indexStage()
+        except StageFailed as e:
+            print(f"Family index failed: {e}")
+            return {}, False
+        parsed = self.parseStage(genes)
+        summary = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = {gene: pool.submit(self.geneChain, gene, *parsed[gene]) for gene in genes}
+            for gene, future in futures.items():
+                summary[gene] = future.result()
+                continue
+        print(f"--- Pipeline finished in {time.perf_counter() - start:.1f}s (family index: {indexStatus}) ---")
+        return summary, not any('failed' in statuses.values() for statuses in summary.values())
+
+
+########################## Helper Functions ##########################
+def splitParserOutput(batchOutput, parseRoot, genes):
+    """Move a multi-gene parser run's output into parseRoot/<gene>/ with
+    the same layout a single gene run produces"""
+    counts = {}
+    for gene in genes:
+        geneDir = parseRoot / gene
+        if geneDir.exists():
+            shutil.rmtree(geneDir)
+        (geneDir / 'speciesCounts').mkdir(parents=True)
+        if (batchOutput / gene).exists():
+            shutil.move((batchOutput / gene).as_posix(), (geneDir / gene).as_posix())
+        for summary in glob.glob((batchOutput / 'speciesCounts' / f"{glob.escape(gene)}_copy_number_summary_chunk_*.txt").as_posix()):
+            shutil.move(summary, (geneDir / 'speciesCounts' / Path(summary).name).as_posix())
+            continue
+        counts[gene] = open(geneDir / 'CumulativeSpeciesCounts.tsv', 'w')
+        continue
+    # Rows are assigned to genes through their <gene>_chunk_<n> Chunk column
+    with open(batchOutput / 'CumulativeSpeciesCounts.tsv') as fh:
+        header = fh.readline()
+        chunkColumn = header.rstrip('\n').split('\t').index('Chunk')
+        for oh in counts.values():
+            oh.write(header)
+            continue
+        for line in fh:
+            gene = line.rstrip('\n').split('\t')[chunkColumn].rsplit('_chunk_', 1)[0]
+            if gene in counts:
+                counts[gene].write(line)
+            continue
+    for oh in counts.values():
+        oh.close()
+        continue
+    return
+
+
+def failedFetches(logDir, gene):
+    """Records the fetcher could not fetch (network/server errors, not
+    unknown IDs) in the newest JSONL run log of gene"""
+    logs = glob.glob((Path(logDir) / f"{glob.escape(gene)}_fetchEnsemblSequences_*.jsonl").as_posix())
+    if not logs:
+        return 0
+    with open(max(logs, key=os.path.getmtime)) as fh:
+        return sum(1 for line in fh if json.loads(line).get('status') == 'failed')
+
+
+def countRows(tsvPath):
+    """Data rows of a TSV file (0 if it is missing)"""
+    try:
+        with open(tsvPath) as fh:
+            return max(0, sum(1 for _ in fh) - 1)
+    except FileNotFoundError:
+        return 0
+
+
+def readGeneList(path):
+    return list(dict.fromkeys(g.strip() for g in open(path) if g.strip()))
+
+
+def printSummary(summary):
+    print('\t'.join(['gene'] + STAGES[1:]))
+    for gene, statuses in summary.items():
+        print('\t'.join([gene] + [statuses.get(stage, '-') for stage in STAGES[1:]]))
+        continue
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the parse -> fetch -> align -> scan workflow, only redoing stages whose inputs changed')
+    parser.add_argument(
+        '-i',
+        '--input',
+        type=str,
+        action='store',
+        required=True,
+        help="Ensembl emf file",
+    )
+    parser.add_argument(
+        '-g',
+        '--INPUT_GENE',
+        type=str,
+        action='store',
+        required=True,
+        help="Gene list (one gene per line) -- same file as the parser's -g",
+    )
+    parser.add_argument(
+        '-s',
+        '--species',
+        type=str,
+        action='store',
+        default=None,
+        help='Species of interest file passed to the parser',
+    )
+    parser.add_argument(
+        '-w',
+        '--work',
+        type=str,
+        action='store',
+        default='./pipeline/',
+        help='Work directory holding every stage output and the pipeline state [default: ./pipeline/]',
+    )
+    parser.add_argument(
+        '--aligner',
+        type=str,
+        action='store',
+        default=None,
+        help='Alignment command with {input} and {output} placeholders, e.g. "mafft --auto {input} > {output}". '
+             'Without it alignments are expected at <work>/alignments/<gene>.fasta',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        action='store',
+        default=4,
+        help='Number of genes fetched, aligned and scanned at the same time',
+    )
+    parser.add_argument(
+        '--rate',
+        type=float,
+        action='store',
+        default=ENSEMBL_REQUESTS_PER_SECOND,
+        help=f'Total Ensembl requests per second, split over the concurrent fetches [default: {ENSEMBL_REQUESTS_PER_SECOND}]',
+    )
+    parser.add_argument('--parser-args', type=str, action='store', default='', help='Extra arguments for the parser, e.g. "--workers 4"')
+    parser.add_argument('--fetch-args', type=str, action='store', default='', help='Extra arguments for the fetcher, e.g. "--fasta dumps/"')
+    parser.add_argument('--scan-args', type=str, action='store', default='', help='Extra arguments for the scanner, e.g. "--max-states 3"')
+    parser.add_argument(
+        '--scan-format',
+        type=str,
+        action='store',
+        choices=['tsv', 'parquet', 'xlsx'],
+        default='tsv',
+        help='Variant table format [default: tsv]',
+    )
+    parser.add_argument(
+        '--force',
+        type=str,
+        action='store',
+        nargs='+',
+        choices=STAGES,
+        default=[],
+        help='Rerun these stages even if they are current',
+    )
+    parser.add_argument(
+        '-n',
+        '--dry-run',
+        action='store_true',
+        help='Only report which stages are current and which would run',
+    )
+    args = parser.parse_args()
+    genes = readGeneList(args.INPUT_GENE)
+    summary, ok = Pipeline(args).run(genes)
+    printSummary(summary)
+    if not ok:
+        sys.exit(1)
+    return
+
+
+if __name__ == '__main__':
+    main()
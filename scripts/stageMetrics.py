@@ -0,0 +1,257 @@
+"""
+Author: Andrew Harris
+Python 3.8
+
+Lightweight per-stage metrics shared by the scripts' --metrics and
+--profile options.
+
+    metrics = StageMetrics()
+    with metrics.stage('prune'):
+        ...
+    metrics.add('bytes_received', len(body))
+    metrics.observe('request_latency_ms', ms)
+    metrics.write('report.json')
+
+For every stage the wall time, number of calls and the process' peak RSS
+when the stage last finished are kept. Nested stages are timed
+inclusively, e.g. 'read' includes the 'split' time inside it. Worker
+processes keep their own StageMetrics and send snapshot() back to the
+parent, which merge()s them. When metrics are off the scripts use
+NULL_METRICS, whose methods do nothing.
+"""
+import cProfile
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peakRssMB():
+    """Peak resident memory of this process so far (0 where unavailable)"""
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def percentile(ordered, q):
+    """Nearest rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {}    # name -> [calls, seconds, peak RSS MB]
+        self.counters = {}  # name -> total
+        self.samples = {}   # name -> [values]
+        return
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def record(self, name, seconds, calls=1):
+        peak = peakRssMB()
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+            stage[2] = max(stage[2], peak)
+        return
+
+    def timeIterator(self, name, iterable):
+        """Yield from iterable, timing every next() as a call of stage name"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record(name, time.perf_counter() - start, calls=0)
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        return
+
+    def observe(self, name, value):
+        with self.lock:
+            self.samples.setdefault(name, []).append(value)
+        return
+
+    def snapshot(self):
+        """Picklable copy of the metrics collected since the last snapshot
+        (for sending from a worker process to the parent)"""
+        with self.lock:
+            snapshot = {'stages': self.stages, 'counters': self.counters, 'samples': self.samples}
+            self.stages, self.counters, self.samples = {}, {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        if not snapshot:
+            return
+        with self.lock:
+            for name, (calls, seconds, peak) in snapshot['stages'].items():
+                stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+                stage[0] += calls
+                stage[1] += seconds
+                stage[2] = max(stage[2], peak)
+                continue
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+                continue
+            for name, values in snapshot['samples'].items():
+                self.samples.setdefault(name, []).extend(values)
+                continue
+        return
+
+    def report(self, **extra):
+        stages = {}
+        for name, (calls, seconds, peak) in self.stages.items():
+            stages[name] = {
+                'calls': calls,
+                'seconds': round(seconds, 6),
+                'mean_ms': round(seconds / calls * 1000, 4) if calls else None,
+                'peak_rss_mb': round(peak, 1),
+            }
+            continue
+        distributions = {}
+        for name, values in self.samples.items():
+            ordered = sorted(values)
+            distributions[name] = {
+                'count': len(ordered),
+                'mean': round(sum(ordered) / len(ordered), 4),
+                'p50': percentile(ordered, 50),
+                'p90': percentile(ordered, 90),
+                'p99': percentile(ordered, 99),
+                'max': ordered[-1],
+            }
+            continue
+        return {
+            **extra,
+            'wall_seconds': round(time.perf_counter() - self.started, 4),
+            'peak_rss_mb': round(peakRssMB(), 1),
+            'stages': stages,
+            'counters': dict(self.counters),
+            'distributions': distributions,
+        }
+
+    def write(self, path, **extra):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(self.report(**extra), indent=2, default=str))
+        return
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullMetrics:
+    """Does nothing -- used when --metrics is not given"""
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def record(self, name, seconds, calls=1):
+        return
+
+    def timeIterator(self, name, iterable):
+        return iterable
+
+    def add(self, name, value=1):
+        return
+
+    def observe(self, name, value):
+        return
+
+    def snapshot(self):
+        return None
+
+    def merge(self, snapshot):
+        return
+
+    def __bool__(self):
+        return False
+
+
+NULL_METRICS = NullMetrics()
+
+
+def makeMetrics(enabled):
+    return StageMetrics() if enabled else NULL_METRICS
+
+
+def startProfile(path):
+    """Start cProfile if path is given. Only the calling process is
+    profiled, not worker processes. Returns the profiler or None."""
+    if path is None:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stopProfile(profiler, path):
+    """Stop a startProfile() profiler and dump its stats (pstats format) to path"""
+    if profiler is None:
+        return
+    profiler.disable()
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(path)
+    print(f"cProfile stats written to {path} (view with: python -m pstats {path})")
+    return
+
+
+def addMetricsArguments(parser):
+    """--metrics + --profile options shared by the scripts"""
+    parser.add_argument(
+        '--metrics',
+        type=str,
+        action='store',
+        default=None,
+        help='Write per stage wall time, call counts and peak memory (+ script specific counters) to this JSON file',
+    )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        action='store',
+        default=None,
+        help='Write cProfile stats of the main process to this file (view with python -m pstats)',
+    )
+    return